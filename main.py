@@ -1,33 +1,1038 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi.routing import APIRoute
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-import pandas as pd
-from datetime import datetime, time, timedelta
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from time import perf_counter
+from datetime import date, datetime, time, timedelta
 from typing import List, Dict, Any
 import traceback
-from sqlalchemy import create_engine, text
-import uvicorn
+import gzip
+import hashlib
+import asyncio
+import contextvars
+import functools
+import importlib
+import io
+import itertools
+import json
+import mimetypes
+import os
+import random
+import re
+import threading
+from sqlalchemy import create_engine, event, exc, text
 
-app = FastAPI(title="Детали в ОТК")
+class LazyModule:
+    """Модуль, который импортируется при первом обращении к атрибуту"""
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# pandas и numpy импортируются лениво (в прогреве при старте), чтобы воркер поднимался быстро
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
+
+@asynccontextmanager
+async def lifespan(app):
+    """Старт: статика и фоновый прогрев; остановка: сброс снимков и пулов"""
+    await on_startup()
+    yield
+    await on_shutdown()
+
+app = FastAPI(title="Детали в ОТК", lifespan=lifespan)
 _db_engines = {}
+_db_engines_lock = threading.Lock()
 
-# Монтируем статические файлы
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+# Профилирование запросов (включается OTK_PROFILING=1): по заголовку X-Profile: 1
+# или для доли запросов OTK_PROFILE_SAMPLE_RATE. Выключенное ничего не подключает
+PROFILING_ENABLED = os.getenv("OTK_PROFILING", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("OTK_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.getenv("OTK_PROFILE_SLOW_MS", "1000"))
+PROFILE_BUFFER_SIZE = int(os.getenv("OTK_PROFILE_BUFFER_SIZE", "50"))
+PANDAS_PROFILE_OPS = ("read_sql_query", "groupby", "agg", "apply", "to_dict", "sort_values", "to_datetime")
+_current_profile = contextvars.ContextVar("otk_profile", default=None)
+# С Python 3.12 cProfile один на процесс: второй enable() в другом потоке - ValueError
+_profiler_lock = threading.Lock()
+_recent_profiles = deque(maxlen=PROFILE_BUFFER_SIZE)
+_slow_profiles = deque(maxlen=PROFILE_BUFFER_SIZE)
+_profile_ids = itertools.count(1)
+
+class RequestProfile:
+    """Разбивка времени одного запроса: БД, pandas, сериализация, полный профиль стека"""
+    
+    def __init__(self, method, path):
+        self.id = next(_profile_ids)
+        self.method = method
+        self.path = path
+        self.started_at = datetime.now()
+        self.total_ms = 0.0
+        self.handler_ms = None
+        self.endpoint_ms = None
+        self.db_ms = 0.0
+        self.db_queries = 0
+        self.db_rows = 0
+        self.pandas_ms = {}
+        self.stack = None
+    
+    def add_endpoint_profile(self, profiler, elapsed):
+        """Время endpoint'а, операции pandas из cProfile и текст профиля"""
+        import pstats
+        
+        self.endpoint_ms = elapsed * 1000
+        stats = pstats.Stats(profiler)
+        for (filename, _, funcname), (_, _, _, _, callers) in stats.stats.items():
+            if funcname not in PANDAS_PROFILE_OPS or "pandas" not in filename:
+                continue
+            # Только вызовы из нашего кода, без вложенных вызовов внутри pandas
+            cumulative = sum(c[3] for caller, c in callers.items() if "pandas" not in caller[0])
+            if cumulative:
+                self.pandas_ms[funcname] = self.pandas_ms.get(funcname, 0) + cumulative * 1000
+        
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats("cumulative").print_stats(40)
+        self.stack = output.getvalue()
+    
+    def serialization_ms(self):
+        """Проверка ответа и JSON-кодирование: обработчик маршрута минус сам endpoint"""
+        if self.handler_ms is None or self.endpoint_ms is None:
+            return None
+        return max(self.handler_ms - self.endpoint_ms, 0)
+    
+    def server_timing(self) -> str:
+        parts = [f"db;dur={self.db_ms:.1f}"]
+        parts += [f"pandas-{op};dur={ms:.1f}" for op, ms in self.pandas_ms.items()]
+        if self.serialization_ms() is not None:
+            parts.append(f"serialize;dur={self.serialization_ms():.1f}")
+        parts.append(f"total;dur={self.total_ms:.1f}")
+        return ", ".join(parts)
+    
+    def summary(self):
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at.isoformat(),
+            "total_ms": round(self.total_ms, 1),
+            "endpoint_ms": round(self.endpoint_ms, 1) if self.endpoint_ms is not None else None,
+            "db_ms": round(self.db_ms, 1),
+            "db_queries": self.db_queries,
+            "db_rows": self.db_rows,
+            "pandas_ms": {op: round(ms, 1) for op, ms in self.pandas_ms.items()},
+            "serialization_ms": round(self.serialization_ms(), 1) if self.serialization_ms() is not None else None,
+            "has_stack": self.stack is not None
+        }
+
+def profile_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_profile.get() is not None:
+        conn.info.setdefault("otk_query_started", []).append(perf_counter())
+
+def profile_after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is None or not conn.info.get("otk_query_started"):
+        return
+    profile.db_ms += (perf_counter() - conn.info["otk_query_started"].pop()) * 1000
+    profile.db_queries += 1
+    if cursor.rowcount and cursor.rowcount > 0:
+        profile.db_rows += cursor.rowcount
+
+def profiled_endpoint(endpoint):
+    """Обертка endpoint'а: при активном профилировании запускает cProfile в его потоке"""
+    def start():
+        # Профиль стека снимает только один запрос за раз; остальные идут без cProfile
+        if _current_profile.get() is None or not _profiler_lock.acquire(blocking=False):
+            return None
+        try:
+            import cProfile
+            
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler, perf_counter()
+        except Exception as e:
+            _profiler_lock.release()
+            print(f"Профилировщик не запущен: {e}")
+            return None
+    
+    def stop(started):
+        profiler, started_at = started
+        try:
+            profiler.disable()
+            _current_profile.get().add_endpoint_profile(profiler, perf_counter() - started_at)
+        except Exception as e:
+            print(f"Ошибка профилировщика: {e}")
+        finally:
+            _profiler_lock.release()
+    
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            started = start()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                if started:
+                    stop(started)
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            started = start()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                if started:
+                    stop(started)
+    return wrapper
+
+class ProfilingRoute(APIRoute):
+    """Маршрут, который замеряет endpoint и сериализацию ответа для профилируемых запросов"""
+    
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, profiled_endpoint(endpoint), **kwargs)
+    
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        
+        async def profiled_handler(request):
+            profile = _current_profile.get()
+            if profile is None:
+                return await handler(request)
+            started = perf_counter()
+            response = await handler(request)
+            profile.handler_ms = (perf_counter() - started) * 1000
+            return response
+        
+        return profiled_handler
 
-def get_db_engine(database="kontakt"):
-    """Создает подключение к PostgreSQL через SQLAlchemy"""
-    if database == "postgres":
-        connection_string = f"postgresql+psycopg2://postgres:sa@192.168.101.12:5432/postgres"
+async def request_profiler(request: Request, call_next):
+    """Профилирует запрос по X-Profile: 1 или по выборке; медленные - в кольцевой буфер"""
+    if request.headers.get("x-profile") != "1" and random.random() >= PROFILE_SAMPLE_RATE:
+        return await call_next(request)
+    
+    profile = RequestProfile(request.method, request.url.path)
+    token = _current_profile.set(profile)
+    started = perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        _current_profile.reset(token)
+    profile.total_ms = (perf_counter() - started) * 1000
+    
+    response.headers["Server-Timing"] = profile.server_timing()
+    response.headers["X-Profile-Id"] = str(profile.id)
+    if profile.total_ms >= PROFILE_SLOW_MS:
+        _slow_profiles.append(profile)
+        print(f"🐢 Медленный запрос {profile.path}: {profile.total_ms:.0f} мс (профиль {profile.id})")
     else:
-        connection_string = f"postgresql+psycopg2://postgres:sa@192.168.101.12:5432/kontakt"
-    return create_engine(connection_string)
+        profile.stack = None
+    _recent_profiles.append(profile)
+    return response
+
+# Выключенный профилировщик не добавляет ни middleware, ни обертку маршрутов
+if PROFILING_ENABLED:
+    app.router.route_class = ProfilingRoute
+    app.middleware("http")(request_profiler)
+
+templates = Jinja2Templates(directory="templates")
+
+# Строки подключения: аналитика может смотреть на реплику (по умолчанию - на основную базу)
+DATABASE_DSNS = {
+    "postgres": os.getenv("OTK_POSTGRES_DSN", "postgresql+psycopg2://postgres:sa@192.168.101.12:5432/postgres"),
+    "kontakt": os.getenv("OTK_KONTAKT_DSN", "postgresql+psycopg2://postgres:sa@192.168.101.12:5432/kontakt")
+}
+ANALYTICS_DSN = os.getenv("OTK_ANALYTICS_DSN", DATABASE_DSNS["kontakt"])
+
+# Отдельные пулы по классам нагрузки: размер пула - это и лимит параллельных запросов класса
+WORKLOAD_POOLS = {
+    "live": {
+        "pool_size": int(os.getenv("OTK_LIVE_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("OTK_LIVE_MAX_OVERFLOW", "5")),
+        "pool_timeout": 5
+    },
+    "analytics": {
+        "pool_size": int(os.getenv("OTK_ANALYTICS_POOL_SIZE", "2")),
+        "max_overflow": int(os.getenv("OTK_ANALYTICS_MAX_OVERFLOW", "0")),
+        # Тяжелые запросы ждут в очереди допуска, а не в пуле (см. ANALYTICS_GATE)
+        "pool_timeout": float(os.getenv("OTK_ANALYTICS_POOL_TIMEOUT", "10"))
+    },
+    # Интерактивный поиск: свой маленький пул, чтобы не ждать за отчетами
+    "search": {
+        "pool_size": int(os.getenv("OTK_SEARCH_POOL_SIZE", "2")),
+        "max_overflow": int(os.getenv("OTK_SEARCH_MAX_OVERFLOW", "1")),
+        "pool_timeout": 2
+    }
+}
+
+# Автомат защиты: после серии сбоев соединения не долбим восстанавливающийся сервер
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("OTK_BREAKER_FAILURES", "3"))
+BREAKER_BASE_DELAY = float(os.getenv("OTK_BREAKER_BASE_DELAY", "2"))
+BREAKER_MAX_DELAY = float(os.getenv("OTK_BREAKER_MAX_DELAY", "60"))
+DB_CONNECT_TIMEOUT = int(os.getenv("OTK_DB_CONNECT_TIMEOUT", "5"))
+# Пробный запрос, не сообщивший результат за это время, считается потерянным
+BREAKER_PROBE_TIMEOUT = float(os.getenv("OTK_BREAKER_PROBE_TIMEOUT", "15"))
+_breakers = {}
+
+class CircuitOpenError(Exception):
+    """База помечена недоступной, запрос не отправляется"""
+
+class CircuitBreaker:
+    """Автомат closed -> open (пауза растет экспоненциально) -> half_open -> closed"""
+    
+    def __init__(self, name):
+        self.name = name
+        self.state = "closed"
+        self.failures = 0
+        self.opened_count = 0
+        self.open_until = None
+        self.probe_started = None
+        self.last_error = None
+        self._lock = threading.Lock()
+    
+    def before_call(self):
+        """
+        Бросает CircuitOpenError, пока пауза после сбоев не истекла. После паузы
+        пропускает один пробный запрос, остальные отклоняются до его результата
+        """
+        with self._lock:
+            now = datetime.now()
+            if self.state == "open":
+                if now < self.open_until:
+                    raise CircuitOpenError(
+                        f"БД {self.name} недоступна, повтор через {(self.open_until - now).total_seconds():.0f} с"
+                    )
+                self.state = "half_open"
+                self.probe_started = None
+            if self.state == "half_open":
+                if (self.probe_started is not None
+                        and (now - self.probe_started).total_seconds() < BREAKER_PROBE_TIMEOUT):
+                    raise CircuitOpenError(f"БД {self.name}: идет пробный запрос, повторите позже")
+                self.probe_started = now
+    
+    def record_success(self):
+        if self.state == "closed" and self.failures == 0:
+            return
+        with self._lock:
+            if self.state != "closed":
+                print(f"✅ Соединение с БД {self.name} восстановлено")
+            self.state = "closed"
+            self.failures = 0
+            self.opened_count = 0
+            self.open_until = None
+            self.probe_started = None
+    
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+            if self.state == "half_open" or self.failures >= BREAKER_FAILURE_THRESHOLD:
+                delay = min(BREAKER_BASE_DELAY * 2 ** self.opened_count, BREAKER_MAX_DELAY)
+                delay *= random.uniform(0.8, 1.2)
+                self.state = "open"
+                self.opened_count += 1
+                self.open_until = datetime.now() + timedelta(seconds=delay)
+                self.probe_started = None
+                print(f"⛔ БД {self.name} недоступна, пауза {delay:.1f} с")
+    
+    def status(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "open_until": self.open_until.isoformat() if self.open_until else None,
+            "probe_in_flight": self.probe_started is not None,
+            "last_error": self.last_error
+        }
+
+def is_connection_error(error) -> bool:
+    """
+    Ошибка связи с БД (а не ошибка запроса). Таймаут ожидания соединения из пула
+    (exc.TimeoutError) сюда не входит: это занятый пул, а не недоступный сервер
+    """
+    return isinstance(error, (exc.OperationalError, exc.InterfaceError, CircuitOpenError))
+
+def get_breaker(database="kontakt", workload="live") -> CircuitBreaker:
+    """
+    Автомат для пары (база, класс нагрузки): сбои тяжелых отчетов на пуле
+    analytics не отключают живую очередь, даже если обе смотрят на один сервер
+    """
+    name = f"{database}/{workload}"
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers.setdefault(name, CircuitBreaker(name))
+    return breaker
+
+def get_db_engine(database="kontakt", workload="live"):
+    """Возвращает SQLAlchemy engine с пулом для базы и класса нагрузки (live/analytics)"""
+    breaker = get_breaker(database, workload)
+    breaker.before_call()
+    
+    key = (database, workload)
+    engine = _db_engines.get(key)
+    if engine is None:
+        with _db_engines_lock:
+            engine = _db_engines.get(key)
+            if engine is None:
+                if database == "kontakt" and workload == "analytics":
+                    connection_string = ANALYTICS_DSN
+                else:
+                    connection_string = DATABASE_DSNS[database]
+                engine = create_engine(
+                    connection_string,
+                    pool_pre_ping=True,
+                    connect_args={"connect_timeout": DB_CONNECT_TIMEOUT},
+                    **WORKLOAD_POOLS[workload]
+                )
+                # Удачная выдача соединения из пула закрывает автомат
+                event.listen(engine, "checkout", lambda *args: breaker.record_success())
+                if PROFILING_ENABLED:
+                    event.listen(engine, "before_cursor_execute", profile_before_cursor_execute)
+                    event.listen(engine, "after_cursor_execute", profile_after_cursor_execute)
+                _db_engines[key] = engine
+    return engine
+
+# Последние удачные ответы основных endpoint'ов (память + файл на диске)
+SNAPSHOT_FILE = os.getenv("OTK_SNAPSHOT_FILE", "snapshots.json")
+SNAPSHOT_FLUSH_SECONDS = 10
+# Ключи зависят от параметров запроса (days, machine, дата) - храним последние N (LRU)
+SNAPSHOT_MAX_ENTRIES = int(os.getenv("OTK_SNAPSHOT_MAX_ENTRIES", "64"))
+_snapshots = OrderedDict()
+_snapshots_lock = threading.Lock()
+_snapshots_flush_lock = threading.Lock()
+_snapshots_state = {"dirty": False, "flushed_at": 0.0}
+
+def load_snapshots():
+    """Читает снимки с диска (после рестарта при лежащей БД)"""
+    if not os.path.exists(SNAPSHOT_FILE):
+        return
+    try:
+        with open(SNAPSHOT_FILE, encoding="utf-8") as f:
+            loaded = json.load(f)
+        with _snapshots_lock:
+            _snapshots.update(loaded)
+            trim_snapshots()
+        print(f"Загружено {len(_snapshots)} снимков из {SNAPSHOT_FILE}")
+    except Exception as e:
+        print(f"Не удалось прочитать снимки {SNAPSHOT_FILE}: {e}")
+
+def trim_snapshots():
+    """Вытесняет давно не использованные снимки сверх SNAPSHOT_MAX_ENTRIES (под _snapshots_lock)"""
+    while len(_snapshots) > SNAPSHOT_MAX_ENTRIES:
+        _snapshots.popitem(last=False)
+
+def encoded_snapshot(entry) -> str:
+    """JSON снимка; кодируется один раз на снимок и запоминается в записи"""
+    encoded = entry.get("json")
+    if encoded is None:
+        encoded = json.dumps({"data": jsonable_encoder(entry["data"]), "saved_at": entry["saved_at"]},
+                             ensure_ascii=False)
+        entry["json"] = encoded
+    return encoded
+
+def flush_snapshots():
+    """
+    Атомарно записывает снимки на диск, если были изменения. Кодируются только
+    новые снимки, остальные берутся уже готовой строкой
+    """
+    with _snapshots_flush_lock:
+        with _snapshots_lock:
+            if not _snapshots_state["dirty"]:
+                return
+            entries = list(_snapshots.items())
+            _snapshots_state["dirty"] = False
+        try:
+            payload = "{" + ",".join(
+                f"{json.dumps(key, ensure_ascii=False)}:{encoded_snapshot(entry)}" for key, entry in entries
+            ) + "}"
+            tmp_path = SNAPSHOT_FILE + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(tmp_path, SNAPSHOT_FILE)
+            _snapshots_state["flushed_at"] = datetime.now().timestamp()
+        except Exception as e:
+            print(f"Не удалось сохранить снимки {SNAPSHOT_FILE}: {e}")
+
+def snapshot_flush_loop():
+    """Фоновый сброс снимков на диск раз в SNAPSHOT_FLUSH_SECONDS (вне цикла событий)"""
+    while True:
+        threading.Event().wait(SNAPSHOT_FLUSH_SECONDS)
+        flush_snapshots()
+
+def remember_snapshot(key, result):
+    """
+    Запоминает удачный ответ как последний известный и возвращает его без изменений.
+    На горячем пути только ссылка на результат: кодирование и запись - в фоновом потоке
+    """
+    with _snapshots_lock:
+        _snapshots[key] = {"data": result, "saved_at": datetime.now().timestamp()}
+        _snapshots.move_to_end(key)
+        trim_snapshots()
+        _snapshots_state["dirty"] = True
+    return result
+
+def snapshot_fallback(key, error, default, database="kontakt", workload="live"):
+    """
+    Ответ при ошибке: последний удачный снимок с пометкой stale и возрастом,
+    либо default, если снимка нет. Списки помечаются заголовками X-Stale*
+    """
+    if is_connection_error(error) and not isinstance(error, CircuitOpenError):
+        get_breaker(database, workload).record_failure(error)
+    
+    with _snapshots_lock:
+        entry = _snapshots.get(key)
+        if entry is not None:
+            _snapshots.move_to_end(key)
+    if entry is None:
+        return default
+    
+    age = round(datetime.now().timestamp() - entry["saved_at"])
+    data = entry["data"]
+    if isinstance(data, dict):
+        return {**data, "stale": True, "stale_age_seconds": age}
+    return JSONResponse(content=jsonable_encoder(data), headers={"X-Stale": "true", "X-Stale-Age": str(age)})
+
+
+# Сброс состояния, которое приложение держит в памяти (после записи результатов ОТК)
+_invalidation_hooks = []
+
+def register_invalidation(hook):
+    """Регистрирует функцию сброса кэша/состояния; используется как декоратор"""
+    _invalidation_hooks.append(hook)
+    return hook
+
+def invalidate_caches():
+    """Сбрасывает все зарегистрированные кэши очереди и статистики"""
+    for hook in _invalidation_hooks:
+        try:
+            hook()
+        except Exception as e:
+            print(f"Ошибка сброса кэша {hook.__name__}: {e}")
+
+# Скользящее окно живой очереди и архив (холодная часть) завершенных задач
+# 0 - окна нет: живая очередь показывает все непроверенные задачи с QUEUE_MIN_DATE
+QUEUE_WINDOW_DAYS = int(os.getenv("OTK_QUEUE_WINDOW_DAYS", "0"))
+QUEUE_MIN_DATE = date.fromisoformat(os.getenv("OTK_QUEUE_MIN_DATE", "2025-09-15"))
+ARCHIVE_AFTER_DAYS = int(os.getenv("OTK_ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("OTK_ARCHIVE_BATCH_SIZE", "5000"))
+ARCHIVE_ENABLED = os.getenv("OTK_ARCHIVE_ENABLED", "0") == "1"
+_archive_state = {"exists": None, "checked_at": None, "last_run": None, "last_moved": 0}
+
+def hot_window_start() -> date:
+    """Начало скользящего окна для живой очереди (не раньше QUEUE_MIN_DATE)"""
+    if QUEUE_WINDOW_DAYS <= 0:
+        return QUEUE_MIN_DATE
+    return max(QUEUE_MIN_DATE, date.today() - timedelta(days=QUEUE_WINDOW_DAYS))
+
+def archive_boundary() -> date:
+    """Проверки раньше этой даты могут лежать в архивной таблице"""
+    return date.today() - timedelta(days=ARCHIVE_AFTER_DAYS)
+
+def archive_exists() -> bool:
+    """Есть ли архивная таблица (результат кэшируется на 5 минут)"""
+    now = datetime.now()
+    if _archive_state["checked_at"] is None or (now - _archive_state["checked_at"]).total_seconds() > 300:
+        with get_db_engine().connect() as conn:
+            regclass = conn.execute(text("SELECT to_regclass('\"KQCDTasks_archive\"')")).scalar()
+        _archive_state["exists"] = regclass is not None
+        _archive_state["checked_at"] = now
+    return _archive_state["exists"]
+
+def tasks_source(start_date=None, alias=None) -> str:
+    """
+    Источник строк KQCDTasks для FROM: только горячая таблица, если период
+    не выходит за границу архива, иначе UNION ALL с архивом
+    """
+    if (start_date is not None and start_date >= archive_boundary()) or not archive_exists():
+        return f'"KQCDTasks" {alias}' if alias else '"KQCDTasks"'
+    union = '(SELECT * FROM "KQCDTasks" UNION ALL SELECT * FROM "KQCDTasks_archive")'
+    return f'{union} {alias}' if alias else f'{union} AS "KQCDTasks"'
+
+def ensure_archive_schema(conn):
+    """Создает архивную таблицу и ее индексы"""
+    conn.execute(text('CREATE TABLE IF NOT EXISTS "KQCDTasks_archive" (LIKE "KQCDTasks" INCLUDING DEFAULTS)'))
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS "KQCDTasks_archive_qcdDateFinish_idx" '
+        'ON "KQCDTasks_archive" ("qcdDateFinish")'
+    ))
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS "KQCDTasks_archive_dateFinish_idx" '
+        'ON "KQCDTasks_archive" ("dateFinish")'
+    ))
+
+def ensure_queue_index():
+    """
+    Частичный индекс живой очереди (только непроверенные задачи). Создается
+    один раз при старте, CONCURRENTLY - без блокировки записи в KQCDTasks
+    """
+    engine = get_db_engine()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS "KQCDTasks_queue_idx" ON "KQCDTasks" ("dateFinish") '
+            'WHERE "qcdUser" IS NULL OR "qcdUser" = \'\''
+        ))
+    print("Индекс живой очереди готов")
+
+def archive_completed_tasks() -> int:
+    """
+    Переносит проверенные задачи старше ARCHIVE_AFTER_DAYS в KQCDTasks_archive
+    короткими транзакциями по ARCHIVE_BATCH_SIZE строк
+    """
+    engine = get_db_engine()
+    cutoff = archive_boundary()
+    move_query = """
+        WITH moved AS (
+            DELETE FROM "KQCDTasks"
+            WHERE id IN (
+                SELECT id FROM "KQCDTasks"
+                WHERE "qcdUser" IS NOT NULL
+                AND "qcdUser" != ''
+                AND "qcdDateFinish" IS NOT NULL
+                AND "qcdDateFinish" < :cutoff
+                LIMIT :batch_size
+            )
+            RETURNING *
+        )
+        INSERT INTO "KQCDTasks_archive" SELECT * FROM moved
+    """
+    
+    with engine.begin() as conn:
+        ensure_archive_schema(conn)
+    _archive_state["checked_at"] = None
+    
+    moved_total = 0
+    while True:
+        with engine.begin() as conn:
+            moved = conn.execute(text(move_query), {'cutoff': cutoff, 'batch_size': ARCHIVE_BATCH_SIZE}).rowcount
+        moved_total += moved
+        if moved < ARCHIVE_BATCH_SIZE:
+            break
+    
+    _archive_state["last_run"] = datetime.now()
+    _archive_state["last_moved"] = moved_total
+    print(f"Архивация: перенесено {moved_total} задач с проверкой до {cutoff}")
+    return moved_total
+
+def archive_loop():
+    """Фоновая архивация раз в сутки (включается OTK_ARCHIVE_ENABLED=1)"""
+    while True:
+        try:
+            archive_completed_tasks()
+        except Exception as e:
+            print(f"Ошибка архивации: {e}")
+            print(traceback.format_exc())
+        threading.Event().wait(24 * 3600)
+
+# Сжатие ответов и условные запросы (ETag) для JSON и HTML
+COMPRESSION_MIN_SIZE = int(os.getenv("OTK_COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSIBLE_TYPES = ("application/json", "text/html")
+
+_brotli = {"loaded": False, "module": None}
+
+def get_brotli():
+    """Ленивый импорт brotli; None, если модуль не установлен (тогда только gzip)"""
+    if not _brotli["loaded"]:
+        try:
+            _brotli["module"] = importlib.import_module("brotli")
+        except ImportError:
+            _brotli["module"] = None
+        _brotli["loaded"] = True
+    return _brotli["module"]
+
+def choose_encoding(accept_encoding: str):
+    """Выбирает кодировку сжатия по Accept-Encoding (br предпочтительнее gzip)"""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[token.strip().lower()] = q
+    
+    if accepted.get("br", 0) > 0 and get_brotli() is not None:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    """Сжимает тело ответа выбранным алгоритмом"""
+    if encoding == "br":
+        return get_brotli().compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+def make_etag(body: bytes, encoding: str = None) -> str:
+    """Строгий ETag по содержимому; у сжатого представления свой суффикс"""
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    return f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+
+def etag_matches(if_none_match: str, body: bytes) -> bool:
+    """Проверяет If-None-Match против ETag любого представления этого содержимого"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    base = make_etag(body).strip('"')
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        candidate = candidate.strip('"')
+        if candidate == base or candidate in (f"{base}-br", f"{base}-gzip"):
+            return True
+    return False
+
+@app.middleware("http")
+async def compress_and_etag(request: Request, call_next):
+    """Сжимает крупные JSON/HTML ответы и отвечает 304, если данные не изменились"""
+    response = await call_next(request)
+    
+    content_type = response.headers.get("content-type", "")
+    if (request.method not in ("GET", "HEAD")
+            or response.status_code != 200
+            or "content-encoding" in response.headers
+            or not content_type.startswith(COMPRESSIBLE_TYPES)):
+        return response
+    
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    headers = {k: v for k, v in response.headers.items() if k.lower() != "content-length"}
+    headers["vary"] = "Accept-Encoding"
+    headers.setdefault("cache-control", "no-cache")
+    
+    if etag_matches(request.headers.get("if-none-match"), body):
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+        if len(body) < COMPRESSION_MIN_SIZE:
+            encoding = None
+        return Response(status_code=304, headers={
+            "etag": make_etag(body, encoding),
+            "vary": headers["vary"],
+            "cache-control": headers["cache-control"]
+        })
+    
+    encoding = None
+    if len(body) >= COMPRESSION_MIN_SIZE:
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+    
+    headers["etag"] = make_etag(body, encoding)
+    if encoding:
+        body = compress_body(body, encoding)
+        headers["content-encoding"] = encoding
+    
+    return Response(content=body, status_code=response.status_code, headers=headers)
+
+# Контроль допуска: лимит параллельных тяжелых запросов с ограниченной очередью.
+# Живая очередь и статистика (/api/data, /api/stats, /api/today-stats) сюда не
+# попадают и допускаются всегда, без ожидания. Ожидание допуска не короче таймаута
+# пула аналитики: допущенный запрос не должен отваливаться по таймауту пула
+ADMISSION_QUEUE_TIMEOUT = max(float(os.getenv("OTK_ADMISSION_QUEUE_TIMEOUT", "10")),
+                              WORKLOAD_POOLS["analytics"]["pool_timeout"])
+ADMISSION_RETRY_AFTER = int(os.getenv("OTK_ADMISSION_RETRY_AFTER", "5"))
+
+class AdmissionGate:
+    """Семафор endpoint'а с ограниченной очередью ожидания и счетчиками для мониторинга"""
+    
+    def __init__(self, name, max_concurrent, max_queue):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+    
+    async def acquire(self) -> bool:
+        """True - запрос допущен; False - очередь полна или ожидание истекло"""
+        if self.in_flight >= self.max_concurrent and self.waiting >= self.max_queue:
+            self.rejected += 1
+            return False
+        
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=ADMISSION_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            return False
+        finally:
+            self.waiting -= 1
+        
+        self.in_flight += 1
+        self.admitted += 1
+        return True
+    
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+    
+    def status(self):
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out
+        }
+
+# Общий лимит всех запросов на пул analytics: не больше, чем в пуле соединений
+ANALYTICS_CONCURRENCY = WORKLOAD_POOLS["analytics"]["pool_size"] + WORKLOAD_POOLS["analytics"]["max_overflow"]
+ANALYTICS_GATE = AdmissionGate("analytics", ANALYTICS_CONCURRENCY, 16)
+
+def analytics_gates(name, max_concurrent, max_queue):
+    """Собственный лимит endpoint'а аналитики плюс общий лимит пула analytics"""
+    return (AdmissionGate(name, min(max_concurrent, ANALYTICS_CONCURRENCY), max_queue), ANALYTICS_GATE)
+
+# Префикс пути -> лимиты (берутся по порядку); порядок важен (первое совпадение)
+ADMISSION_GATES = [
+    ("/api/operators-stats", analytics_gates("operators-stats", 2, 8)),
+    ("/api/employee-stats", analytics_gates("employee-stats", 2, 8)),
+    ("/api/qc-wait-stats", analytics_gates("qc-wait-stats", 2, 8)),
+    ("/api/employees-checked-parts", analytics_gates("employees-checked-parts", 2, 8)),
+    ("/api/employee-checked-parts/", analytics_gates("employee-checked-parts", 4, 16)),
+    ("/api/employees-data", (AdmissionGate("employees-data", 4, 16),)),
+    ("/api/admin/archive", (AdmissionGate("archive", 1, 0),)),
+    ("/api/search", (AdmissionGate(
+        "search", WORKLOAD_POOLS["search"]["pool_size"] + WORKLOAD_POOLS["search"]["max_overflow"], 32
+    ),))
+]
+
+def find_admission_gates(path: str):
+    """Лимиты для пути или пустой кортеж, если endpoint допускается всегда"""
+    for prefix, gates in ADMISSION_GATES:
+        if path.startswith(prefix):
+            return gates
+    return ()
+
+def all_admission_gates():
+    """Все лимиты без повторов (общий лимит analytics - один раз)"""
+    gates = {}
+    for _, route_gates in ADMISSION_GATES:
+        for gate in route_gates:
+            gates.setdefault(gate.name, gate)
+    return list(gates.values())
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    """Быстрый 503 + Retry-After для тяжелых запросов сверх лимита"""
+    gates = find_admission_gates(request.url.path)
+    if not gates:
+        return await call_next(request)
+    
+    acquired = []
+    try:
+        for gate in gates:
+            if not await gate.acquire():
+                print(f"Запрос {request.url.path} отклонен: очередь {gate.name} заполнена")
+                return JSONResponse(
+                    status_code=503,
+                    content={"error": "Сервер перегружен, повторите запрос позже", "retry_after": ADMISSION_RETRY_AFTER},
+                    headers={"Retry-After": str(ADMISSION_RETRY_AFTER)}
+                )
+            acquired.append(gate)
+        return await call_next(request)
+    finally:
+        for gate in reversed(acquired):
+            gate.release()
+
+# Статика: имена с отпечатком содержимого, предсжатые варианты, вечный кэш
+STATIC_DIR = "static"
+TEMPLATES_DIR = "templates"
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+ASSET_COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+_asset_manifest = {}        # "css/app.css" -> "css/app.1a2b3c4d5e6f.css"
+_fingerprinted_assets = {}  # "css/app.1a2b3c4d5e6f.css" -> тип, ETag и варианты тела
+_shell_cache = {"key": None, "html": None}
+
+def build_asset_manifest(directory=STATIC_DIR):
+    """Считает отпечатки файлов статики и готовит gzip/br варианты в памяти"""
+    manifest = {}
+    assets = {}
+    if not os.path.isdir(directory):
+        print(f"Каталог статики {directory} не найден")
+        return
+    
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            if filename.endswith((".gz", ".br")):
+                continue
+            full_path = os.path.join(root, filename)
+            rel_path = os.path.relpath(full_path, directory).replace(os.sep, "/")
+            with open(full_path, "rb") as f:
+                content = f.read()
+            
+            digest = hashlib.sha256(content).hexdigest()[:12]
+            stem, ext = os.path.splitext(rel_path)
+            fingerprinted = f"{stem}.{digest}{ext}"
+            media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            
+            variants = {"identity": content}
+            if len(content) >= COMPRESSION_MIN_SIZE and media_type.startswith(ASSET_COMPRESSIBLE_TYPES):
+                # Готовые .gz/.br рядом с файлом (из сборки) имеют приоритет
+                for encoding, suffix in (("gzip", ".gz"), ("br", ".br")):
+                    if os.path.exists(full_path + suffix):
+                        with open(full_path + suffix, "rb") as f:
+                            variants[encoding] = f.read()
+                if "gzip" not in variants:
+                    variants["gzip"] = gzip.compress(content, compresslevel=9)
+                if "br" not in variants and get_brotli() is not None:
+                    variants["br"] = get_brotli().compress(content, quality=11)
+            
+            manifest[rel_path] = fingerprinted
+            assets[fingerprinted] = {"media_type": media_type, "digest": digest, "variants": variants}
+    
+    _asset_manifest.clear()
+    _asset_manifest.update(manifest)
+    _fingerprinted_assets.clear()
+    _fingerprinted_assets.update(assets)
+    _shell_cache["key"] = None
+    print(f"Статика: {len(manifest)} файлов с отпечатками")
+
+def asset_url(path: str) -> str:
+    """URL файла статики с отпечатком (или исходный, если файла нет в манифесте)"""
+    path = path.lstrip("/")
+    return f"/static/{_asset_manifest.get(path, path)}"
+
+_STATIC_REF_RE = re.compile(r"/static/([^\"'\s)?#]+)")
+
+def rewrite_asset_refs(html: str) -> str:
+    """Заменяет ссылки /static/... в разметке на имена с отпечатком"""
+    return _STATIC_REF_RE.sub(lambda m: asset_url(m.group(1)), html)
+
+def render_shell(request: Request) -> str:
+    """Рендерит index.html один раз и держит результат в памяти"""
+    template_path = os.path.join(TEMPLATES_DIR, "index.html")
+    key = (os.path.getmtime(template_path), str(request.base_url))
+    if _shell_cache["key"] != key:
+        html = templates.get_template("index.html").render({"request": request})
+        _shell_cache["html"] = rewrite_asset_refs(html)
+        _shell_cache["key"] = key
+    return _shell_cache["html"]
+
+class FingerprintedStaticFiles(StaticFiles):
+    """StaticFiles, отдающий файлы с отпечатком из памяти с immutable-кэшем"""
+    
+    async def get_response(self, path: str, scope):
+        asset = _fingerprinted_assets.get(path.replace(os.sep, "/"))
+        if asset is None:
+            return await super().get_response(path, scope)
+        
+        request_headers = Request(scope).headers
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""))
+        if encoding not in asset["variants"]:
+            encoding = None
+        
+        headers = {
+            "cache-control": ASSET_CACHE_CONTROL,
+            "vary": "Accept-Encoding",
+            "etag": f'"{asset["digest"]}-{encoding}"' if encoding else f'"{asset["digest"]}"'
+        }
+        if asset["digest"] in request_headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        
+        if encoding:
+            headers["content-encoding"] = encoding
+        return Response(content=asset["variants"][encoding or "identity"],
+                        media_type=asset["media_type"], headers=headers)
+
+templates.env.globals["asset_url"] = asset_url
+
+# Монтируем статические файлы
+app.mount("/static", FingerprintedStaticFiles(directory=STATIC_DIR), name="static")
+
+# Начальные данные (очередь и статистика) встраиваются прямо в страницу
+INITIAL_DATA_TTL = int(os.getenv("OTK_INITIAL_DATA_TTL", "10"))
+_initial_data_cache = {"built_at": None, "script": None, "task": None}
+
+async def build_initial_data() -> dict:
+    """Собирает очередь и статистику через основные endpoint'ы (из снимков)"""
+    started = datetime.now().timestamp()
+    await get_otk_queue()
+    await get_stats()
+    await get_today_stats()
+    
+    keys = {
+        "data": "data",
+        "stats": "stats",
+        "today_stats": f"today-stats?date={datetime.now().date()}"
+    }
+    initial_data = {}
+    stale = False
+    for name, key in keys.items():
+        entry = _snapshots.get(key)
+        initial_data[name] = entry["data"] if entry else None
+        if entry is None or entry["saved_at"] < started:
+            stale = True
+    initial_data["stale"] = stale
+    initial_data["generated"] = datetime.now().isoformat()
+    return initial_data
+
+def initial_data_script(initial_data: dict) -> str:
+    """<script> с данными; экранирование не дает закрыть тег изнутри JSON"""
+    payload = json.dumps(jsonable_encoder(initial_data), ensure_ascii=False)
+    for char, escaped in (("<", "\\u003c"), (">", "\\u003e"), ("&", "\\u0026"),
+                          ("\u2028", "\\u2028"), ("\u2029", "\\u2029")):
+        payload = payload.replace(char, escaped)
+    return f"<script>window.__INITIAL_DATA__ = {payload};</script>"
+
+async def rebuild_initial_data():
+    """
+    Пересобирает скрипт в пуле потоков: endpoint'ы внутри синхронно ходят в БД,
+    поэтому им нужен свой цикл событий, а не основной
+    """
+    try:
+        initial_data = await run_in_threadpool(asyncio.run, build_initial_data())
+        _initial_data_cache["script"] = initial_data_script(initial_data)
+        _initial_data_cache["built_at"] = datetime.now()
+    except Exception as e:
+        print(f"Ошибка сборки начальных данных страницы: {e}")
+    finally:
+        _initial_data_cache["task"] = None
+
+async def get_initial_data_script() -> str:
+    """
+    Скрипт с начальными данными из короткоживущего кэша (INITIAL_DATA_TTL).
+    Устаревший скрипт отдается сразу, а пересборка идет в фоне (одна на процесс);
+    ждем только самую первую сборку, когда отдавать еще нечего
+    """
+    built_at = _initial_data_cache["built_at"]
+    if built_at is None or (datetime.now() - built_at).total_seconds() >= INITIAL_DATA_TTL:
+        task = _initial_data_cache["task"]
+        if task is None:
+            task = _initial_data_cache["task"] = start_background(rebuild_initial_data())
+        if _initial_data_cache["script"] is None:
+            await asyncio.shield(task)
+    return _initial_data_cache["script"] or ""
+
+@register_invalidation
+def invalidate_initial_data():
+    """Следующий запрос страницы запустит пересборку с уже записанными результатами"""
+    _initial_data_cache["built_at"] = None
+
+def embed_initial_data(html: str, script: str) -> str:
+    """Вставляет скрипт перед </head> (до скриптов страницы), иначе перед </body>"""
+    for tag in ("</head>", "</body>"):
+        position = html.find(tag)
+        if position != -1:
+            return html[:position] + script + html[position:]
+    return html + script
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
-    """Главная страница"""
-    return templates.TemplateResponse("index.html", {"request": request})
+    """Главная страница: кэшированная оболочка со статикой по отпечаткам и встроенными данными"""
+    return HTMLResponse(embed_initial_data(render_shell(request), await get_initial_data_script()))
 
 @app.get("/api/otk-employees")
 async def get_otk_employees():
@@ -67,10 +1072,12 @@ async def get_otk_employees():
             print("Пробуем альтернативный запрос...")
             return await get_otk_employees_alternative()
         
-        return employees
+        return remember_snapshot("otk-employees", employees)
         
     except Exception as e:
         print(f"Ошибка при загрузке сотрудников ОТК: {e}")
+        if is_connection_error(e):
+            return snapshot_fallback("otk-employees", e, [], database="postgres")
         print(traceback.format_exc())
         return await get_otk_employees_alternative()
 
@@ -114,7 +1121,7 @@ async def get_otk_employees_alternative():
             
             employees = users_df.to_dict('records')
             print(f"Возвращаем всех пользователей ({len(employees)} записей)")
-            return employees
+            return remember_snapshot("otk-employees", employees)
         
         # Ищем сотрудников по найденным ID отделов
         employees_query = """
@@ -132,11 +1139,11 @@ async def get_otk_employees_alternative():
         employees = employees_df.to_dict('records')
         print(f"Альтернативный метод: найдено {len(employees)} сотрудников")
         
-        return employees
+        return remember_snapshot("otk-employees", employees)
         
     except Exception as e:
         print(f"Ошибка альтернативного метода: {e}")
-        return []
+        return snapshot_fallback("otk-employees", e, [], database="postgres")
 
 @app.get("/api/debug-otk-employees")
 async def debug_otk_employees():
@@ -269,7 +1276,7 @@ async def get_otk_queue() -> List[Dict[str, Any]]:
                 ON kt.barcode = ko.barcode
             WHERE (kt."qcdUser" IS NULL OR kt."qcdUser" = '')
             AND kt."dateFinish" IS NOT NULL
-            AND kt."dateFinish" >= '2025-09-15'
+            AND kt."dateFinish" >= :window_start
             AND kt."operatorAmount" > 0
             ORDER BY 
                 CASE WHEN ko."isPriority" = TRUE THEN 0 ELSE 1 END,
@@ -278,7 +1285,7 @@ async def get_otk_queue() -> List[Dict[str, Any]]:
         """
         
         with engine.connect() as conn:
-            df = pd.read_sql_query(text(query), conn)
+            df = pd.read_sql_query(text(query), conn, params={'window_start': hot_window_start()})
         
         # Преобразуем NULL в False для приоритета
         df['is_critical_priority'] = df['is_critical_priority'].fillna(False)
@@ -305,15 +1312,15 @@ async def get_otk_queue() -> List[Dict[str, Any]]:
                 debug_df = pd.read_sql_query(text(debug_query), conn)
                 print("Приоритетные позиции в БД (все):", debug_df.to_dict('records'))
         
-        return data
+        return remember_snapshot("data", data)
         
     except Exception as e:
         print(f"Ошибка при загрузке данных: {e}")
         print(traceback.format_exc())
-        return []
+        return snapshot_fallback("data", e, [])
 
 @app.get("/api/check-specific")
-async def check_specific():
+async def check_specific(barcode: str = '20250820-3952-1-5'):
     """Проверяем конкретную приоритетную позицию"""
     try:
         engine = get_db_engine()
@@ -328,13 +1335,13 @@ async def check_specific():
                 kt."dateFinish",
                 kt."operatorAmount",
                 ko."isPriority"
-            FROM "KQCDTasks" kt
+            FROM {tasks}
             LEFT JOIN "KOperations" ko ON kt.barcode = ko.barcode
-            WHERE kt.barcode = '20250820-3952-1-5'
-        """
+            WHERE kt.barcode = :barcode
+        """.format(tasks=tasks_source(alias="kt"))
         
         with engine.connect() as conn:
-            df = pd.read_sql_query(text(query), conn)
+            df = pd.read_sql_query(text(query), conn, params={'barcode': barcode})
         
         return {
             "specific_item": df.to_dict('records'),
@@ -362,11 +1369,11 @@ async def get_all_priority_items():
                 kt."dateFinish",
                 kt."operatorAmount",
                 ko."isPriority"
-            FROM "KQCDTasks" kt
+            FROM {tasks}
             INNER JOIN "KOperations" ko ON kt.barcode = ko.barcode
             WHERE ko."isPriority" = TRUE
             ORDER BY kt."dateFinish" DESC
-        """
+        """.format(tasks=tasks_source(alias="kt"))
         
         with engine.connect() as conn:
             df = pd.read_sql_query(text(query), conn)
@@ -395,7 +1402,7 @@ async def get_stats():
             FROM "KQCDTasks" 
             WHERE ("qcdUser" IS NULL OR "qcdUser" = '')
             AND "dateFinish" IS NOT NULL
-            AND "dateFinish" >= '2025-09-15'
+            AND "dateFinish" >= :window_start
             AND "operatorAmount" > 0
         """
         
@@ -412,7 +1419,7 @@ async def get_stats():
         
         with engine.connect() as conn:
             # Получаем количество непроверенных позиций
-            result_unchecked = conn.execute(text(query_unchecked))
+            result_unchecked = conn.execute(text(query_unchecked), {'window_start': hot_window_start()})
             total = result_unchecked.scalar()
             
             # Получаем количество проверенных СЕГОДНЯ позиций
@@ -421,16 +1428,16 @@ async def get_stats():
         
         print(f"Статистика: {total} ожидают, {checked_today} проверено сегодня")
         
-        return {
+        return remember_snapshot("stats", {
             "total": total,
             "checked_today": checked_today,
             "updated": datetime.now().isoformat()
-        }
+        })
         
     except Exception as e:
         print(f"Ошибка статистики: {e}")
         print(traceback.format_exc())
-        return {"total": 0, "checked_today": 0, "updated": datetime.now().isoformat()}
+        return snapshot_fallback("stats", e, {"total": 0, "checked_today": 0, "updated": datetime.now().isoformat()})
 
 @app.get("/api/debug-priority")
 async def debug_priority():
@@ -518,23 +1525,24 @@ async def get_today_stats():
             'quantity': 'part_count'
         })
         
-        return {
+        return remember_snapshot(f"today-stats?date={today}", {
             "total_positions": int(total_positions),
             "total_parts": int(total_parts),
             "users": users_stats.to_dict('records'),
             "orders": df.to_dict('records')
-        }
+        })
         
     except Exception as e:
         print(f"Ошибка при загрузке сегодняшней статистики: {e}")
         print(traceback.format_exc())
-        return {"total_positions": 0, "total_parts": 0, "users": [], "orders": []}
+        return snapshot_fallback(f"today-stats?date={datetime.now().date()}", e,
+                                 {"total_positions": 0, "total_parts": 0, "users": [], "orders": []})
     
 @app.get("/api/employee-stats")
-async def get_employee_stats(days: int = 7):
+def get_employee_stats(days: int = 7):
     """Возвращает статистику по сотрудникам за указанный период"""
     try:
-        engine = get_db_engine()
+        engine = get_db_engine(workload="analytics")
         start_date = (datetime.now() - timedelta(days=days)).date()
         
         # ИСПРАВЛЕННЫЙ ЗАПРОС
@@ -544,14 +1552,14 @@ async def get_employee_stats(days: int = 7):
                 DATE("qcdDateFinish") as check_date,
                 COUNT(DISTINCT id) as position_count,
                 COALESCE(SUM("qcdAmount"), 0) as part_count
-            FROM "KQCDTasks" 
+            FROM {tasks} 
             WHERE "qcdUser" IS NOT NULL 
             AND "qcdUser" != ''
             AND "qcdDateFinish" IS NOT NULL
             AND DATE("qcdDateFinish") >= :start_date
             GROUP BY "qcdUser", DATE("qcdDateFinish")
             ORDER BY check_date DESC, qcd_user
-        """
+        """.format(tasks=tasks_source(start_date))
         
         with engine.connect() as conn:
             df = pd.read_sql_query(text(query), conn, params={'start_date': start_date})
@@ -562,14 +1570,14 @@ async def get_employee_stats(days: int = 7):
                 "qcdUser" as qcd_user,
                 COUNT(DISTINCT id) as position_count,
                 COALESCE(SUM("qcdAmount"), 0) as part_count
-            FROM "KQCDTasks" 
+            FROM {tasks} 
             WHERE "qcdUser" IS NOT NULL 
             AND "qcdUser" != ''
             AND "qcdDateFinish" IS NOT NULL
             AND DATE("qcdDateFinish") >= :start_date
             GROUP BY "qcdUser"
             ORDER BY position_count DESC
-        """
+        """.format(tasks=tasks_source(start_date))
         
         with engine.connect() as conn:
             total_stats_df = pd.read_sql_query(text(total_stats_query), conn, params={'start_date': start_date})
@@ -577,26 +1585,27 @@ async def get_employee_stats(days: int = 7):
         print(f"Загружено {len(df)} записей статистики за {days} дней")
         print(f"Уникальных сотрудников: {total_stats_df['qcd_user'].nunique()}")
         
-        return {
+        return remember_snapshot(f"employee-stats?days={days}", {
             "daily_stats": df.to_dict('records'),
             "total_stats": total_stats_df.to_dict('records'),
             "period_days": days
-        }
+        })
         
     except Exception as e:
         print(f"Ошибка при загрузке статистики сотрудников: {e}")
         print(traceback.format_exc())
-        return {"daily_stats": [], "total_stats": [], "period_days": days}
+        return snapshot_fallback(f"employee-stats?days={days}", e,
+                                 {"daily_stats": [], "total_stats": [], "period_days": days},
+                                 workload="analytics")
 
 @app.get("/api/employee-data/{employee_name}")
 async def get_employee_data(employee_name: str, days: int = 1):
     """Возвращает данные для конкретного сотрудника ОТК"""
+    # Декодируем имя сотрудника до обращения к БД - оно нужно и в ответе при ошибке
+    employee_name_decoded = employee_name.replace('_', ' ')
     try:
         engine = get_db_engine()
         
-        # Декодируем имя сотрудника
-        employee_name_decoded = employee_name.replace('_', ' ')
-        
         # Ожидающие проверки детали (все)
         waiting_query = """
             SELECT 
@@ -610,7 +1619,7 @@ async def get_employee_data(employee_name: str, days: int = 1):
             FROM "KQCDTasks" 
             WHERE ("qcdUser" IS NULL OR "qcdUser" = '')
             AND "dateFinish" IS NOT NULL
-            AND "dateFinish" >= '2025-09-15'
+            AND "dateFinish" >= :window_start
             AND "operatorAmount" > 0
             ORDER BY "dateFinish" ASC
             LIMIT 50
@@ -624,17 +1633,17 @@ async def get_employee_data(employee_name: str, days: int = 1):
                 "machineName" as machine_name,
                 "operatorAmount" as quantity,
                 "qcdDateFinish" as qcd_date_finish
-            FROM "KQCDTasks" 
+            FROM {tasks} 
             WHERE "qcdUser" = :employee_name
             AND "operatorAmount" > 0
             AND "qcdDateFinish" IS NOT NULL
             AND DATE("qcdDateFinish") >= CURRENT_DATE - INTERVAL ':days days'
             ORDER BY "qcdDateFinish" DESC
             LIMIT 50
-        """
+        """.format(tasks=tasks_source(date.today() - timedelta(days=days)))
         
         with engine.connect() as conn:
-            waiting_df = pd.read_sql_query(text(waiting_query), conn)
+            waiting_df = pd.read_sql_query(text(waiting_query), conn, params={'window_start': hot_window_start()})
             checked_df = pd.read_sql_query(text(checked_query), conn, 
                                          params={'employee_name': employee_name_decoded, 'days': days})
         
@@ -650,10 +1659,10 @@ async def get_employee_data(employee_name: str, days: int = 1):
 
 
 @app.get("/api/employee-checked-parts/{employee_name}")
-async def get_employee_checked_parts(employee_name: str):
+def get_employee_checked_parts(employee_name: str):
     """Возвращает все проверенные детали сотрудника (поиск по фамилии)"""
     try:
-        engine = get_db_engine()
+        engine = get_db_engine(workload="analytics")
         import urllib.parse
         employee_name_decoded = urllib.parse.unquote(employee_name)
         
@@ -678,12 +1687,12 @@ async def get_employee_checked_parts(employee_name: str):
                 "qcdComment" as qcd_comment,
                 "qcdDateFinish" as qcd_date_finish,
                 "qcdUser"
-            FROM "KQCDTasks" 
+            FROM {tasks} 
             WHERE "qcdUser" LIKE :surname_pattern
             AND "qcdDateFinish" IS NOT NULL
             ORDER BY "qcdDateFinish" DESC
             LIMIT 200
-        """
+        """.format(tasks=tasks_source())
         
         with engine.connect() as conn:
             df = pd.read_sql_query(text(query), conn, 
@@ -708,6 +1717,165 @@ async def get_employee_checked_parts(employee_name: str):
         print(traceback.format_exc())
         return {"checked_parts": [], "employee_name": employee_name, "total_count": 0}
 
+@app.post("/api/employees-data")
+async def get_employees_data(request: Request):
+    """Данные сразу для нескольких сотрудников ОТК одним запросом (вместо N вызовов employee-data)"""
+    employee_names = []
+    try:
+        data = await request.json()
+        employee_names = [name.replace('_', ' ') for name in data.get("employee_names", [])]
+        days = int(data.get("days", 1))
+        engine = get_db_engine()
+        
+        # Ожидающие проверки детали общие для всех сотрудников
+        waiting_query = """
+            SELECT 
+                "orderNumber" as order_number,
+                "partName" as part_name,
+                "machineName" as machine_name,
+                operator,
+                "dateFinish" as date_finish,
+                "operatorAmount" as quantity,
+                FALSE as is_critical_priority
+            FROM "KQCDTasks" 
+            WHERE ("qcdUser" IS NULL OR "qcdUser" = '')
+            AND "dateFinish" IS NOT NULL
+            AND "dateFinish" >= :window_start
+            AND "operatorAmount" > 0
+            ORDER BY "dateFinish" ASC
+            LIMIT 50
+        """
+        
+        # Проверенные детали всех сотрудников: итоги и последние 50 строк на каждого
+        checked_query = """
+            SELECT * FROM (
+                SELECT 
+                    "qcdUser" as qcd_user,
+                    "orderNumber" as order_number,
+                    "partName" as part_name,
+                    "machineName" as machine_name,
+                    "operatorAmount" as quantity,
+                    "qcdDateFinish" as qcd_date_finish,
+                    COUNT(*) OVER (PARTITION BY "qcdUser") as position_count,
+                    SUM("operatorAmount") OVER (PARTITION BY "qcdUser") as part_count,
+                    ROW_NUMBER() OVER (PARTITION BY "qcdUser" ORDER BY "qcdDateFinish" DESC) as rn
+                FROM {tasks} 
+                WHERE "qcdUser" = ANY(:employee_names)
+                AND "operatorAmount" > 0
+                AND "qcdDateFinish" IS NOT NULL
+                AND DATE("qcdDateFinish") >= CURRENT_DATE - :days * INTERVAL '1 day'
+            ) ranked
+            WHERE rn <= 50
+            ORDER BY qcd_user, qcd_date_finish DESC
+        """.format(tasks=tasks_source(date.today() - timedelta(days=days)))
+        
+        with engine.connect() as conn:
+            waiting_df = pd.read_sql_query(text(waiting_query), conn, params={'window_start': hot_window_start()})
+            checked_df = pd.read_sql_query(text(checked_query), conn,
+                                           params={'employee_names': employee_names, 'days': days})
+        
+        employees = {}
+        groups = dict(tuple(checked_df.groupby('qcd_user')))
+        for name in employee_names:
+            group = groups.get(name)
+            if group is None:
+                employees[name] = {"checked_parts": [], "position_count": 0, "part_count": 0}
+                continue
+            employees[name] = {
+                "checked_parts": group.drop(columns=['qcd_user', 'position_count', 'part_count', 'rn']).to_dict('records'),
+                "position_count": int(group['position_count'].iloc[0]),
+                "part_count": int(group['part_count'].iloc[0])
+            }
+        
+        print(f"Пакетная загрузка данных: {len(employee_names)} сотрудников, {len(checked_df)} строк")
+        
+        return {
+            "waiting_parts": waiting_df.to_dict('records'),
+            "employees": employees,
+            "period_days": days
+        }
+        
+    except Exception as e:
+        print(f"Ошибка пакетной загрузки данных сотрудников: {e}")
+        print(traceback.format_exc())
+        return {
+            "waiting_parts": [],
+            "employees": {name: {"checked_parts": [], "position_count": 0, "part_count": 0} for name in employee_names},
+            "period_days": 0
+        }
+
+@app.post("/api/employees-checked-parts")
+async def get_employees_checked_parts(request: Request):
+    """Проверенные детали нескольких сотрудников (поиск по фамилиям) одним запросом"""
+    employee_names = []
+    try:
+        data = await request.json()
+        employee_names = data.get("employee_names", [])
+        engine = get_db_engine(workload="analytics")
+        
+        # Фамилия - первое слово имени, как в /api/employee-checked-parts
+        surnames = {name: (name.split()[0] if name.split() else name) for name in employee_names}
+        
+        query = """
+            SELECT * FROM (
+                SELECT 
+                    s.surname,
+                    "orderNumber" as order_number,
+                    "partName" as part_name,
+                    "machineName" as machine_name,
+                    operator,
+                    "dateStart" as date_start,
+                    "dateFinish" as date_finish,
+                    "operatorAmount" as operator_amount,
+                    "qcdAmount" as qcd_amount,
+                    "qcdDefect" as qcd_defect,
+                    "qcdComment" as qcd_comment,
+                    "qcdDateFinish" as qcd_date_finish,
+                    "qcdUser",
+                    ROW_NUMBER() OVER (PARTITION BY s.surname ORDER BY "qcdDateFinish" DESC) as rn
+                FROM {tasks}
+                INNER JOIN unnest(CAST(:surnames AS text[])) AS s(surname)
+                    ON "qcdUser" LIKE s.surname || '%'
+                WHERE "qcdDateFinish" IS NOT NULL
+            ) ranked
+            WHERE rn <= 200
+            ORDER BY surname, qcd_date_finish DESC
+        """.format(tasks=tasks_source())
+        
+        def read_checked_parts():
+            with engine.connect() as conn:
+                return pd.read_sql_query(text(query), conn,
+                                         params={'surnames': sorted(set(surnames.values()))})
+        
+        # Аналитический запрос выполняем в пуле потоков, не блокируя живую очередь
+        df = await run_in_threadpool(read_checked_parts)
+        
+        groups = dict(tuple(df.groupby('surname')))
+        employees = {}
+        for name, surname in surnames.items():
+            group = groups.get(surname)
+            parts = group.drop(columns=['surname', 'rn']).to_dict('records') if group is not None else []
+            employees[name] = {
+                "checked_parts": parts,
+                "employee_name": name,
+                "surname_used": surname,
+                "total_count": len(parts)
+            }
+        
+        print(f"✅ Пакетный поиск: {len(employee_names)} сотрудников, {len(df)} записей")
+        
+        return {"employees": employees, "total_count": len(df)}
+        
+    except Exception as e:
+        print(f"❌ Ошибка пакетной загрузки проверенных деталей: {e}")
+        print(traceback.format_exc())
+        return {
+            "employees": {
+                name: {"checked_parts": [], "employee_name": name, "total_count": 0} for name in employee_names
+            },
+            "total_count": 0
+        }
+
 @app.get("/api/debug-employee-search/{employee_name}")
 async def debug_employee_search(employee_name: str):
     """Отладочный endpoint для поиска сотрудников"""
@@ -724,12 +1892,12 @@ async def debug_employee_search(employee_name: str):
             SELECT DISTINCT 
                 "qcdUser",
                 COUNT(*) as total_records
-            FROM "KQCDTasks" 
+            FROM {tasks} 
             WHERE "qcdUser" LIKE :surname_pattern
             AND "qcdDateFinish" IS NOT NULL
             GROUP BY "qcdUser"
             ORDER BY total_records DESC
-        """
+        """.format(tasks=tasks_source())
         
         with engine.connect() as conn:
             df = pd.read_sql_query(text(query), conn, 
@@ -758,14 +1926,14 @@ async def debug_qcd_users():
                 COUNT(*) as total_checks,
                 MIN("qcdDateFinish") as first_check,
                 MAX("qcdDateFinish") as last_check
-            FROM "KQCDTasks" 
+            FROM {tasks} 
             WHERE "qcdUser" IS NOT NULL 
             AND "qcdUser" != ''
             AND "qcdDateFinish" IS NOT NULL
             GROUP BY "qcdUser"
             ORDER BY total_checks DESC
             LIMIT 50
-        """
+        """.format(tasks=tasks_source())
         
         with engine.connect() as conn:
             df = pd.read_sql_query(text(query), conn)
@@ -779,42 +1947,234 @@ async def debug_qcd_users():
         return {"error": str(e), "traceback": traceback.format_exc()}
 
     
-@app.get("/api/operators-stats")
-async def get_operators_stats(days: int = 30, machine: str = "all"):
-    """Возвращает статистику по операторам за указанный период"""
-    try:
-        engine = get_db_engine()
-        start_date = (datetime.now() - timedelta(days=days)).date()
-        
-        # Улучшенный запрос с проверкой дат
-        base_query = """
+# Колоночный куб (день x оператор x станок) для /api/operators-stats
+CUBE_DAYS = int(os.getenv("OTK_CUBE_DAYS", "400"))
+CUBE_REFRESH_SECONDS = int(os.getenv("OTK_CUBE_REFRESH_SECONDS", "60"))
+# Запас на транзакции, закоммиченные позже своего NOW()
+CUBE_REFRESH_SLACK = timedelta(minutes=5)
+
+OPERATORS_AGG_COLUMNS = """
+    operator,
+    "machineName" as machine_name,
+    MIN("dateStart") as date_start,
+    MAX("dateFinish") as date_finish,
+    SUM("operatorAmount") as produced,
+    COALESCE(SUM("qcdAmount"), 0) as accepted,
+    COALESCE(SUM("qcdDefect"), 0) as defects
+"""
+
+class OperatorsCube:
+    """
+    Агрегаты KQCDTasks по (день dateFinish, оператор, станок) в массивах NumPy.
+    Любой период и станок считаются маской и bincount без обращения к БД;
+    при обновлении пересчитываются только дни, где появились или проверены задачи
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operators = []
+        self.operator_index = {}
+        self.machines = []
+        self.machine_index = {}
+        self.all_machines = []
+        self.tz = None
+        self.columns = None  # day (ordinal), operator, machine, produced, accepted, defects, date_start, date_finish
+        self.watermark = None
+        self.refreshed_at = None
+    
+    def _index(self, names, index, values):
+        """Номера имен в справочнике (новые имена дописываются)"""
+        result = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            idx = index.get(value)
+            if idx is None:
+                idx = index[value] = len(names)
+                names.append(value)
+            result[i] = idx
+        return result
+    
+    def _to_ns(self, series):
+        """Время в float-наносекундах (NaN вместо NULL) для fmin/fmax"""
+        series = pd.to_datetime(series)
+        epoch = pd.Timestamp(0)
+        if series.dt.tz is not None:
+            self.tz = series.dt.tz
+            epoch = pd.Timestamp(0, tz="UTC")
+        return ((series - epoch) / pd.Timedelta(nanoseconds=1)).to_numpy(dtype=np.float64, na_value=np.nan)
+    
+    def _from_ns(self, values):
+        result = pd.to_datetime(values, unit='ns', utc=self.tz is not None)
+        return result.tz_convert(self.tz) if self.tz is not None else result
+    
+    def _sum(self, inverse, values, size):
+        """Сумма по ячейкам; количества деталей - целые, как в SQL"""
+        return np.rint(np.bincount(inverse, weights=values, minlength=size)).astype(np.int64)
+    
+    def _load_days(self, conn, start_date, days=None):
+        """Агрегаты по дням из БД: за все дни с start_date или только за days"""
+        query = """
             SELECT 
-                operator,
-                "machineName" as machine_name,
-                MIN("dateStart") as date_start,
-                MAX("dateFinish") as date_finish,
-                SUM("operatorAmount") as produced,
-                COALESCE(SUM("qcdAmount"), 0) as accepted,
-                COALESCE(SUM("qcdDefect"), 0) as defects
-            FROM "KQCDTasks" 
+                DATE("dateFinish") as day,
+                {columns}
+            FROM {tasks} 
             WHERE operator IS NOT NULL 
             AND operator != ''
+            AND "machineName" IS NOT NULL
             AND "operatorAmount" > 0
             AND "dateFinish" IS NOT NULL
             AND DATE("dateFinish") >= :start_date
-        """
-        
+        """.format(columns=OPERATORS_AGG_COLUMNS, tasks=tasks_source(start_date))
         params = {'start_date': start_date}
-        if machine != "all":
-            base_query += " AND \"machineName\" = :machine_name"
-            params['machine_name'] = machine
+        if days is not None:
+            query += ' AND DATE("dateFinish") = ANY(:days)'
+            params['days'] = days
+        query += ' GROUP BY DATE("dateFinish"), operator, "machineName"'
         
-        base_query += " GROUP BY operator, \"machineName\""
+        df = pd.read_sql_query(text(query), conn, params=params)
+        return {
+            "day": np.array([d.toordinal() for d in pd.to_datetime(df['day']).dt.date], dtype=np.int32),
+            "operator": self._index(self.operators, self.operator_index, df['operator'].tolist()),
+            "machine": self._index(self.machines, self.machine_index, df['machine_name'].tolist()),
+            "produced": df['produced'].to_numpy(dtype=np.float64),
+            "accepted": df['accepted'].to_numpy(dtype=np.float64),
+            "defects": df['defects'].to_numpy(dtype=np.float64),
+            "date_start": self._to_ns(df['date_start']),
+            "date_finish": self._to_ns(df['date_finish'])
+        }
+    
+    def refresh(self, force=False):
+        """Первая загрузка целиком, дальше - пересчет только затронутых дней"""
+        with self.lock:
+            now = datetime.now()
+            if (not force and self.refreshed_at is not None
+                    and (now - self.refreshed_at).total_seconds() < CUBE_REFRESH_SECONDS):
+                return
+            
+            start_date = date.today() - timedelta(days=CUBE_DAYS)
+            engine = get_db_engine(workload="analytics")
+            with engine.connect() as conn:
+                db_now = conn.execute(text("SELECT NOW()")).scalar()
+                
+                if self.columns is None:
+                    self.columns = self._load_days(conn, start_date)
+                    machines_query = "SELECT DISTINCT \"machineName\" FROM \"KQCDTasks\" WHERE \"machineName\" IS NOT NULL"
+                    self.all_machines = pd.read_sql_query(text(machines_query), conn)['machineName'].tolist()
+                    print(f"Куб операторов загружен: {len(self.columns['day'])} ячеек")
+                else:
+                    changed_query = """
+                        SELECT DISTINCT DATE("dateFinish") as day
+                        FROM "KQCDTasks"
+                        WHERE "dateFinish" IS NOT NULL
+                        AND DATE("dateFinish") >= :start_date
+                        AND ("dateFinish" >= :watermark OR "qcdDateFinish" >= :watermark)
+                    """
+                    changed_days = [row[0] for row in conn.execute(
+                        text(changed_query), {'start_date': start_date, 'watermark': self.watermark}
+                    )]
+                    if changed_days:
+                        fresh = self._load_days(conn, start_date, changed_days)
+                        keep = ~np.isin(self.columns["day"], [d.toordinal() for d in changed_days])
+                        self.columns = {
+                            name: np.concatenate([values[keep], fresh[name]])
+                            for name, values in self.columns.items()
+                        }
+                        for name in self.machines:
+                            if name not in self.all_machines:
+                                self.all_machines.append(name)
+                        print(f"Куб операторов: пересчитано дней {len(changed_days)}")
+            
+            self.watermark = db_now - CUBE_REFRESH_SLACK
+            self.refreshed_at = now
+    
+    def query(self, days, machine="all"):
+        """Сводка по (оператор, станок) за последние days дней - векторно по маске"""
+        with self.lock:
+            columns = self.columns
+            operators = list(self.operators)
+            machines = list(self.machines)
+            all_machines = list(self.all_machines)
         
-        with engine.connect() as conn:
-            df = pd.read_sql_query(text(base_query), conn, params=params)
+        start_date = (datetime.now() - timedelta(days=days)).date()
+        mask = columns["day"] >= start_date.toordinal()
+        if machine != "all":
+            machine_idx = self.machine_index.get(machine, -1)
+            mask &= columns["machine"] == machine_idx
+        
+        keys = columns["operator"][mask].astype(np.int64) * max(len(machines), 1) + columns["machine"][mask]
+        cells, inverse = np.unique(keys, return_inverse=True)
+        
+        date_start = np.full(len(cells), np.nan)
+        date_finish = np.full(len(cells), np.nan)
+        np.fmin.at(date_start, inverse, columns["date_start"][mask])
+        np.fmax.at(date_finish, inverse, columns["date_finish"][mask])
+        
+        grouped_stats = pd.DataFrame({
+            "operator": [operators[i] for i in cells // max(len(machines), 1)],
+            "machine_name": [machines[i] for i in cells % max(len(machines), 1)],
+            "produced": self._sum(inverse, columns["produced"][mask], len(cells)),
+            "accepted": self._sum(inverse, columns["accepted"][mask], len(cells)),
+            "defects": self._sum(inverse, columns["defects"][mask], len(cells)),
+            "date_start": self._from_ns(date_start),
+            "date_finish": self._from_ns(date_finish)
+        })
+        return grouped_stats, all_machines
+
+operators_cube = OperatorsCube()
+
+@register_invalidation
+def invalidate_operators_cube():
+    """Следующий запрос сразу пересчитает затронутые дни куба"""
+    operators_cube.refreshed_at = None
+
+def operators_stats_from_sql(days, machine):
+    """Сводка по (оператор, станок) прямым SQL - для периодов длиннее куба"""
+    engine = get_db_engine(workload="analytics")
+    start_date = (datetime.now() - timedelta(days=days)).date()
+    
+    base_query = """
+        SELECT 
+            {columns}
+        FROM {tasks} 
+        WHERE operator IS NOT NULL 
+        AND operator != ''
+        AND "operatorAmount" > 0
+        AND "dateFinish" IS NOT NULL
+        AND DATE("dateFinish") >= :start_date
+    """.format(columns=OPERATORS_AGG_COLUMNS, tasks=tasks_source(start_date))
+    
+    params = {'start_date': start_date}
+    if machine != "all":
+        base_query += " AND \"machineName\" = :machine_name"
+        params['machine_name'] = machine
+    
+    base_query += " GROUP BY operator, \"machineName\""
+    
+    machines_query = "SELECT DISTINCT \"machineName\" FROM \"KQCDTasks\" WHERE \"machineName\" IS NOT NULL"
+    with engine.connect() as conn:
+        df = pd.read_sql_query(text(base_query), conn, params=params)
+        machines_df = pd.read_sql_query(text(machines_query), conn)
+    
+    # Строки без станка в сводку не попадают (как и раньше при группировке)
+    grouped_stats = df.groupby(['operator', 'machine_name']).agg({
+        'produced': 'sum',
+        'accepted': 'sum',
+        'defects': 'sum',
+        'date_start': 'min',
+        'date_finish': 'max'
+    }).reset_index()
+    return grouped_stats, machines_df['machineName'].tolist()
+
+@app.get("/api/operators-stats")
+def get_operators_stats(days: int = 30, machine: str = "all"):
+    """Возвращает статистику по операторам за указанный период"""
+    try:
+        if days <= CUBE_DAYS:
+            operators_cube.refresh()
+            grouped_stats, machines_list = operators_cube.query(days, machine)
+        else:
+            grouped_stats, machines_list = operators_stats_from_sql(days, machine)
         
-        if df.empty:
+        if grouped_stats.empty:
             return {
                 "operators_stats": [],
                 "summary": {
@@ -829,28 +2189,6 @@ async def get_operators_stats(days: int = 30, machine: str = "all"):
                 "period_days": days
             }
         
-        # Рассчитываем качество (избегаем деление на ноль)
-        df['quality_rate'] = df.apply(
-            lambda x: round((x['accepted'] / x['produced'] * 100), 2) if x['produced'] > 0 else 0, 
-            axis=1
-        )
-        df['defect_rate'] = df.apply(
-            lambda x: round((x['defects'] / x['produced'] * 100), 2) if x['produced'] > 0 else 0, 
-            axis=1
-        )
-        
-        # Сортируем по качеству
-        df = df.sort_values('quality_rate', ascending=False)
-        
-        # Группируем по оператору и станку
-        grouped_stats = df.groupby(['operator', 'machine_name']).agg({
-            'produced': 'sum',
-            'accepted': 'sum',
-            'defects': 'sum',
-            'date_start': 'min',
-            'date_finish': 'max'
-        }).reset_index()
-        
         # Рассчитываем дополнительные метрики
         grouped_stats['quality_rate'] = (grouped_stats['accepted'] / grouped_stats['produced'] * 100).round(2)
         grouped_stats['defect_rate'] = (grouped_stats['defects'] / grouped_stats['produced'] * 100).round(2)
@@ -887,15 +2225,9 @@ async def get_operators_stats(days: int = 30, machine: str = "all"):
                 "avg_quality": round(avg_quality, 2)
             }
         
-        # Получаем список станков для фильтра
-        machines_query = "SELECT DISTINCT \"machineName\" FROM \"KQCDTasks\" WHERE \"machineName\" IS NOT NULL"
-        with engine.connect() as conn:
-            machines_df = pd.read_sql_query(text(machines_query), conn)
-        machines_list = machines_df['machineName'].tolist()
-        
         print(f"Статистика операторов: {len(grouped_stats)} записей за {days} дней")
         
-        return {
+        return remember_snapshot(f"operators-stats?days={days}&machine={machine}", {
             "operators_stats": grouped_stats.to_dict('records'),
             "summary": {
                 "total_operators": len(grouped_stats),
@@ -907,12 +2239,12 @@ async def get_operators_stats(days: int = 30, machine: str = "all"):
             "analysis": analysis,
             "machines": machines_list,
             "period_days": days
-        }
+        })
         
     except Exception as e:
         print(f"Ошибка при загрузке статистики операторов: {e}")
         print(traceback.format_exc())
-        return {
+        return snapshot_fallback(f"operators-stats?days={days}&machine={machine}", e, {
             "operators_stats": [],
             "summary": {
                 "total_operators": 0,
@@ -924,7 +2256,816 @@ async def get_operators_stats(days: int = 30, machine: str = "all"):
             "analysis": {},
             "machines": [],
             "period_days": days
+        }, workload="analytics")
+
+# Аналитика ожидания ОТК: сливаемые t-digest по дню, станку и контролеру
+QC_WAIT_BACKFILL_DAYS = int(os.getenv("OTK_QC_WAIT_BACKFILL_DAYS", "180"))
+QC_WAIT_REFRESH_SECONDS = int(os.getenv("OTK_QC_WAIT_REFRESH_SECONDS", "30"))
+# Перечитываем последние минуты: qcdDateFinish = NOW() берется на старте транзакции,
+# и поздно закоммиченная проверка может оказаться старше уже учтенного максимума
+QC_WAIT_REFRESH_SLACK = timedelta(minutes=5)
+
+class TDigest:
+    """Сливаемый t-digest для потоковой оценки перцентилей"""
+    
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.centroids = []  # [[среднее, вес], ...] по возрастанию среднего
+        self.buffer = []
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+    
+    def add_many(self, values):
+        """Добавляет наблюдения одной пачкой"""
+        for value in values:
+            self.buffer.append([float(value), 1])
+            self.total += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+        self.count += len(values)
+        if len(self.buffer) >= self.compression * 5:
+            self._compress()
+    
+    def merge(self, other):
+        """Вливает другой дайджест (other не изменяется)"""
+        if other.count == 0:
+            return self
+        self.buffer.extend([list(c) for c in other.centroids])
+        self.buffer.extend([list(c) for c in other.buffer])
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        if len(self.buffer) >= self.compression * 5:
+            self._compress()
+        return self
+    
+    def _compress(self):
+        items = sorted(self.centroids + self.buffer, key=lambda c: c[0])
+        self.buffer = []
+        if not items:
+            self.centroids = []
+            return
+        
+        merged = [list(items[0])]
+        cumulative = 0.0
+        for mean, weight in items[1:]:
+            current = merged[-1]
+            q = (cumulative + (current[1] + weight) / 2) / self.count
+            limit = 4 * self.count * q * (1 - q) / self.compression
+            if current[1] + weight <= max(limit, 1):
+                new_weight = current[1] + weight
+                current[0] += (mean - current[0]) * weight / new_weight
+                current[1] = new_weight
+            else:
+                cumulative += current[1]
+                merged.append([mean, weight])
+        self.centroids = merged
+    
+    def quantile(self, q):
+        """Оценка квантиля q (0..1)"""
+        if self.buffer:
+            self._compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+        
+        target = q * self.count
+        cumulative = 0.0
+        for i, (mean, weight) in enumerate(self.centroids):
+            center = cumulative + weight / 2
+            if target <= center:
+                if i == 0:
+                    value = self.min + (mean - self.min) * target / center
+                else:
+                    prev_mean, prev_weight = self.centroids[i - 1]
+                    prev_center = cumulative - prev_weight / 2
+                    value = prev_mean + (mean - prev_mean) * (target - prev_center) / (center - prev_center)
+                return min(max(value, self.min), self.max)
+            cumulative += weight
+        
+        last_mean, last_weight = self.centroids[-1]
+        last_center = self.count - last_weight / 2
+        value = last_mean + (self.max - last_mean) * (target - last_center) / (last_weight / 2)
+        return min(max(value, self.min), self.max)
+    
+    def summary(self):
+        """Перцентили ожидания в минутах"""
+        def minutes(seconds):
+            return round(seconds / 60, 1) if seconds is not None else None
+        return {
+            "count": int(self.count),
+            "mean_minutes": minutes(self.total / self.count) if self.count else None,
+            "p50_minutes": minutes(self.quantile(0.5)),
+            "p90_minutes": minutes(self.quantile(0.9)),
+            "p99_minutes": minutes(self.quantile(0.99))
         }
+
+_qc_wait_lock = threading.Lock()
+_qc_wait_state = {
+    "sketches": {},          # (день, станок, контролер) -> TDigest (ожидание в секундах)
+    "throughput": {},        # (час, станок, контролер) -> количество проверок
+    "watermark": None,       # нижняя граница следующей догрузки (максимум минус запас)
+    "seen_ids": {},          # id -> qcdDateFinish учтенных строк не старше watermark
+    "refreshed_at": None
+}
+
+def evict_qc_wait_keys(state, cutoff):
+    """Удаляет дни и часы старше окна догрузки, чтобы состояние не росло бесконечно"""
+    for key in [key for key in state["sketches"] if key[0] < cutoff]:
+        del state["sketches"][key]
+    for key in [key for key in state["throughput"] if key[0].date() < cutoff]:
+        del state["throughput"][key]
+
+def refresh_qc_wait_sketches(force=False):
+    """Догружает новые проверки (qcdDateFinish >= watermark) в дневные дайджесты"""
+    with _qc_wait_lock:
+        state = _qc_wait_state
+        now = datetime.now()
+        if (not force and state["refreshed_at"] is not None
+                and (now - state["refreshed_at"]).total_seconds() < QC_WAIT_REFRESH_SECONDS):
+            return
+        
+        cutoff = date.today() - timedelta(days=QC_WAIT_BACKFILL_DAYS)
+        watermark = state["watermark"]
+        if watermark is None:
+            watermark = datetime.combine(cutoff, time.min)
+        
+        query = """
+            SELECT 
+                id,
+                COALESCE("machineName", '') as machine_name,
+                "qcdUser" as qcd_user,
+                "qcdDateFinish" as qcd_date_finish,
+                EXTRACT(EPOCH FROM ("qcdDateFinish" - "dateFinish")) as wait_seconds
+            FROM {tasks} 
+            WHERE "qcdUser" IS NOT NULL 
+            AND "qcdUser" != ''
+            AND "dateFinish" IS NOT NULL
+            AND "qcdDateFinish" >= :watermark
+        """.format(tasks=tasks_source(watermark.date()))
+        
+        engine = get_db_engine(workload="analytics")
+        with engine.connect() as conn:
+            df = pd.read_sql_query(text(query), conn, params={'watermark': watermark})
+        
+        # Строки из запаса перечитываются каждый раз - учитываем только новые id
+        df = df[~df['id'].isin(state["seen_ids"].keys())]
+        if not df.empty:
+            df['wait_seconds'] = df['wait_seconds'].astype(float).clip(lower=0)
+            df['check_day'] = df['qcd_date_finish'].dt.date
+            df['check_hour'] = df['qcd_date_finish'].dt.floor('h')
+            
+            for key, group in df.groupby(['check_day', 'machine_name', 'qcd_user']):
+                state["sketches"].setdefault(key, TDigest()).add_many(group['wait_seconds'].tolist())
+            for key, count in df.groupby(['check_hour', 'machine_name', 'qcd_user']).size().items():
+                state["throughput"][key] = state["throughput"].get(key, 0) + int(count)
+            
+            new_watermark = df['qcd_date_finish'].max().to_pydatetime() - QC_WAIT_REFRESH_SLACK
+            if new_watermark > watermark:
+                watermark = new_watermark
+            recent = df[df['qcd_date_finish'] >= watermark]
+            state["seen_ids"].update(zip(recent['id'], recent['qcd_date_finish'].dt.to_pydatetime()))
+        
+        state["watermark"] = watermark
+        state["seen_ids"] = {
+            task_id: finished for task_id, finished in state["seen_ids"].items() if finished >= watermark
+        }
+        evict_qc_wait_keys(state, cutoff)
+        state["refreshed_at"] = now
+        print(f"Дайджесты ожидания ОТК: +{len(df)} проверок, всего ключей {len(state['sketches'])}")
+
+@register_invalidation
+def invalidate_qc_wait_sketches():
+    """Следующий запрос аналитики сразу догрузит новые проверки"""
+    _qc_wait_state["refreshed_at"] = None
+
+@app.get("/api/qc-wait-stats")
+def get_qc_wait_stats(days: int = 30, machine: str = "all", qcd_user: str = "all"):
+    """Перцентили ожидания ОТК (dateFinish -> qcdDateFinish) и почасовая пропускная способность"""
+    # Дайджесты хранятся только за окно догрузки - больший период честно урезаем
+    requested_days = days
+    days = max(1, min(days, QC_WAIT_BACKFILL_DAYS))
+    try:
+        refresh_qc_wait_sketches()
+        start_date = (datetime.now() - timedelta(days=days)).date()
+        
+        overall = TDigest()
+        by_machine = {}
+        by_user = {}
+        hourly = {}
+        with _qc_wait_lock:
+            for (check_day, machine_name, user), sketch in _qc_wait_state["sketches"].items():
+                if check_day < start_date:
+                    continue
+                if machine != "all" and machine_name != machine:
+                    continue
+                if qcd_user != "all" and user != qcd_user:
+                    continue
+                overall.merge(sketch)
+                by_machine.setdefault(machine_name, TDigest()).merge(sketch)
+                by_user.setdefault(user, TDigest()).merge(sketch)
+            
+            for (check_hour, machine_name, user), count in _qc_wait_state["throughput"].items():
+                if check_hour.date() < start_date:
+                    continue
+                if machine != "all" and machine_name != machine:
+                    continue
+                if qcd_user != "all" and user != qcd_user:
+                    continue
+                hourly[check_hour] = hourly.get(check_hour, 0) + count
+        
+        machines_stats = [{"machine_name": name, **sketch.summary()} for name, sketch in by_machine.items()]
+        users_stats = [{"qcd_user": name, **sketch.summary()} for name, sketch in by_user.items()]
+        
+        return remember_snapshot(f"qc-wait-stats?days={days}&machine={machine}&qcd_user={qcd_user}", {
+            "overall": overall.summary(),
+            "by_machine": sorted(machines_stats, key=lambda x: x["p90_minutes"] or 0, reverse=True),
+            "by_qcd_user": sorted(users_stats, key=lambda x: x["count"], reverse=True),
+            "hourly_throughput": [
+                {"hour": hour.isoformat(), "checked": count} for hour, count in sorted(hourly.items())
+            ],
+            "period_days": days,
+            "requested_days": requested_days
+        })
+        
+    except Exception as e:
+        print(f"Ошибка при расчете ожидания ОТК: {e}")
+        print(traceback.format_exc())
+        return snapshot_fallback(f"qc-wait-stats?days={days}&machine={machine}&qcd_user={qcd_user}", e, {
+            "overall": TDigest().summary(),
+            "by_machine": [],
+            "by_qcd_user": [],
+            "hourly_throughput": [],
+            "period_days": days,
+            "requested_days": requested_days
+        }, workload="analytics")
+
+class QCResultsConflict(Exception):
+    """Часть задач пакета уже проверена или не найдена (для атомарной записи)"""
+
+def write_qc_results(rows, atomic=False):
+    """
+    Записывает пакет результатов ОТК одной транзакцией. Строки передаются
+    массивами через unnest (один запрос вместо N), задача обновляется только
+    если qcdUser еще пустой (оптимистичная проверка)
+    """
+    update_query = """
+        UPDATE "KQCDTasks" kt
+        SET "qcdUser" = s.qcd_user,
+            "qcdAmount" = s.qcd_amount,
+            "qcdDefect" = s.qcd_defect,
+            "qcdComment" = s.qcd_comment,
+            "qcdDateFinish" = NOW()
+        FROM unnest(
+            CAST(:task_ids AS bigint[]),
+            CAST(:qcd_users AS text[]),
+            CAST(:qcd_amounts AS integer[]),
+            CAST(:qcd_defects AS integer[]),
+            CAST(:qcd_comments AS text[])
+        ) AS s(task_id, qcd_user, qcd_amount, qcd_defect, qcd_comment)
+        WHERE kt.id = s.task_id
+        AND (kt."qcdUser" IS NULL OR kt."qcdUser" = '')
+        RETURNING kt.id
+    """
+    
+    conflicts_query = """
+        SELECT id, "qcdUser" as qcd_user
+        FROM "KQCDTasks"
+        WHERE id = ANY(:task_ids)
+    """
+    
+    params = {
+        'task_ids': [row["task_id"] for row in rows],
+        'qcd_users': [row["qcd_user"] for row in rows],
+        'qcd_amounts': [row["qcd_amount"] for row in rows],
+        'qcd_defects': [row["qcd_defect"] for row in rows],
+        'qcd_comments': [row["qcd_comment"] for row in rows]
+    }
+    
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        applied = set(conn.execute(text(update_query), params).scalars().all())
+        missing = [task_id for task_id in params['task_ids'] if task_id not in applied]
+        conflicts = []
+        if missing:
+            existing = dict(conn.execute(text(conflicts_query), {'task_ids': missing}).fetchall())
+            for task_id in missing:
+                if task_id in existing:
+                    conflicts.append({"task_id": task_id, "reason": "already_checked", "qcd_user": existing[task_id]})
+                else:
+                    conflicts.append({"task_id": task_id, "reason": "not_found"})
+            if atomic:
+                # Откатываем всю транзакцию - пакет записывается целиком или никак
+                raise QCResultsConflict(conflicts)
+    
+    return sorted(applied), conflicts
+
+@app.post("/api/qc-results")
+async def save_qc_results(request: Request):
+    """
+    Принимает пакет результатов ОТК:
+    {"results": [{"task_id", "qcd_user", "qcd_amount", "qcd_defect", "qcd_comment"}], "atomic": false}
+    """
+    try:
+        data = await request.json()
+        results = data.get("results", [])
+        atomic = bool(data.get("atomic", False))
+        
+        rows = []
+        errors = []
+        seen_ids = set()
+        for index, item in enumerate(results):
+            try:
+                row = {
+                    "task_id": int(item["task_id"]),
+                    "qcd_user": str(item["qcd_user"]).strip(),
+                    "qcd_amount": int(item["qcd_amount"]),
+                    "qcd_defect": int(item.get("qcd_defect") or 0),
+                    "qcd_comment": item.get("qcd_comment")
+                }
+            except (KeyError, TypeError, ValueError) as e:
+                errors.append({"index": index, "message": f"Некорректная запись: {e}"})
+                continue
+            if not row["qcd_user"]:
+                errors.append({"index": index, "message": "Не указан qcd_user"})
+            elif row["qcd_amount"] < 0 or row["qcd_defect"] < 0:
+                errors.append({"index": index, "message": "Количество не может быть отрицательным"})
+            elif row["task_id"] in seen_ids:
+                errors.append({"index": index, "message": f"Задача {row['task_id']} повторяется в пакете"})
+            else:
+                seen_ids.add(row["task_id"])
+                rows.append(row)
+        
+        if errors:
+            return {"status": "error", "message": "Пакет не записан", "errors": errors}
+        if not rows:
+            return {"status": "success", "applied": [], "conflicts": []}
+        
+        try:
+            applied, conflicts = await run_in_threadpool(write_qc_results, rows, atomic)
+        except QCResultsConflict as e:
+            return {"status": "conflict", "message": "Пакет не записан", "applied": [], "conflicts": e.args[0]}
+        
+        if applied:
+            invalidate_caches()
+        print(f"✅ Результаты ОТК: записано {len(applied)}, конфликтов {len(conflicts)}")
+        
+        return {"status": "success", "applied": applied, "conflicts": conflicts}
+        
+    except Exception as e:
+        print(f"❌ Ошибка записи результатов ОТК: {e}")
+        print(traceback.format_exc())
+        return {"status": "error", "message": str(e)}
+
+@app.post("/api/admin/archive")
+def run_archive():
+    """
+    Ручной запуск переноса старых проверенных задач в архив. Удаляет строки из
+    KQCDTasks, поэтому доступен только при OTK_ARCHIVE_ENABLED=1; выполняется
+    в пуле потоков - пачки DELETE/INSERT не блокируют цикл событий
+    """
+    if not ARCHIVE_ENABLED:
+        return JSONResponse(status_code=403, content={
+            "status": "error",
+            "message": "Архивация выключена (OTK_ARCHIVE_ENABLED=0)"
+        })
+    try:
+        moved = archive_completed_tasks()
+        return {"status": "success", "moved": moved, "cutoff": archive_boundary().isoformat()}
+    except Exception as e:
+        print(f"Ошибка архивации: {e}")
+        print(traceback.format_exc())
+        return {"status": "error", "message": str(e)}
+
+@app.get("/api/admin/archive")
+async def get_archive_status():
+    """Настройки окна очереди и состояние архива"""
+    return {
+        "queue_window_start": hot_window_start().isoformat(),
+        "archive_boundary": archive_boundary().isoformat(),
+        "archive_enabled": ARCHIVE_ENABLED,
+        "archive_exists": _archive_state["exists"],
+        "last_run": _archive_state["last_run"].isoformat() if _archive_state["last_run"] else None,
+        "last_moved": _archive_state["last_moved"]
+    }
+
+@app.get("/api/db-pools")
+async def get_db_pools():
+    """Состояние пулов соединений и автоматов защиты БД"""
+    return {
+        "pools": {
+            f"{database}/{workload}": {
+                "size": engine.pool.size(),
+                "checked_out": engine.pool.checkedout(),
+                "overflow": engine.pool.overflow(),
+                "status": engine.pool.status()
+            }
+            for (database, workload), engine in list(_db_engines.items())
+        },
+        "breakers": {name: breaker.status() for name, breaker in list(_breakers.items())},
+        "snapshots": {
+            key: {"saved_at": datetime.fromtimestamp(entry["saved_at"]).isoformat()}
+            for key, entry in list(_snapshots.items())
+        }
+    }
+
+# Наблюдатель SLA: время ожидания непроверенных задач и оповещения о превышениях.
+# Каждый тик читает только новые задачи (dateFinish >= watermark - запас) и статус уже ожидающих
+SLA_TICK_SECONDS = int(os.getenv("OTK_SLA_TICK_SECONDS", "30"))
+# Новые задачи перечитываются с запасом: задача с dateFinish раньше watermark
+# может закоммититься уже после тика (дубликаты отсекает setdefault по id)
+SLA_REFRESH_SLACK = timedelta(minutes=5)
+
+def validate_sla_thresholds(data) -> dict:
+    """
+    Проверяет пороги целиком: {"<станок>": {"priority": минуты, "regular": минуты}}.
+    Оба порога обязательны и положительны; иначе ValueError и ничего не меняется
+    """
+    if not isinstance(data, dict):
+        raise ValueError("ожидается объект {станок: {priority, regular}}")
+    validated = {}
+    for machine_name, thresholds in data.items():
+        if not isinstance(thresholds, dict):
+            raise ValueError(f"{machine_name}: ожидается объект с priority и regular")
+        validated[machine_name] = {}
+        for kind in ("priority", "regular"):
+            value = thresholds.get(kind)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{machine_name}.{kind}: ожидается число минут")
+            if not 0 < value < float("inf"):
+                raise ValueError(f"{machine_name}.{kind}: порог должен быть больше 0")
+            validated[machine_name][kind] = float(value)
+    return validated
+
+SLA_THRESHOLDS = {"default": {"priority": 60, "regular": 480}}  # минуты, по станкам
+try:
+    SLA_THRESHOLDS.update(validate_sla_thresholds(json.loads(os.getenv("OTK_SLA_THRESHOLDS", "{}"))))
+except ValueError as e:
+    print(f"❌ OTK_SLA_THRESHOLDS проигнорирован, используются пороги по умолчанию: {e}")
+_sla_state = {
+    "waiting": {},      # id -> задача в очереди ОТК
+    "alerts": {},       # id -> превышение порога
+    "watermark": None,  # максимальный dateFinish среди загруженных задач
+    "last_tick": None,
+    "tick_ms": None
+}
+_sla_subscribers = set()
+_sla_wakeup = asyncio.Event()
+
+def sla_threshold(machine_name, is_priority) -> float:
+    """Порог ожидания в минутах для станка (или default)"""
+    thresholds = SLA_THRESHOLDS.get(machine_name) or SLA_THRESHOLDS["default"]
+    return thresholds["priority" if is_priority else "regular"]
+
+def sla_tick():
+    """Обновляет ожидающие задачи инкрементально и возвращает новые/снятые оповещения"""
+    started = datetime.now()
+    state = _sla_state
+    engine = get_db_engine()
+    
+    new_query = """
+        SELECT 
+            kt.id,
+            kt."orderNumber" as order_number,
+            kt."partName" as part_name,
+            kt."machineName" as machine_name,
+            kt.operator,
+            kt.barcode,
+            kt."dateFinish" as date_finish,
+            kt."operatorAmount" as quantity,
+            EXISTS (
+                SELECT 1 FROM "KOperations" ko
+                WHERE ko.barcode = kt.barcode AND ko."isPriority" = TRUE
+            ) as is_priority
+        FROM "KQCDTasks" kt
+        WHERE (kt."qcdUser" IS NULL OR kt."qcdUser" = '')
+        AND kt."dateFinish" IS NOT NULL
+        AND kt."dateFinish" >= :since
+        AND kt."operatorAmount" > 0
+    """
+    
+    # Уже ожидающие: проверены ли и не сменился ли приоритет
+    changed_query = """
+        SELECT 
+            kt.id,
+            kt."qcdUser" as qcd_user,
+            EXISTS (
+                SELECT 1 FROM "KOperations" ko
+                WHERE ko.barcode = kt.barcode AND ko."isPriority" = TRUE
+            ) as is_priority
+        FROM "KQCDTasks" kt
+        WHERE kt.id = ANY(:ids)
+    """
+    
+    if state["watermark"] is None:
+        since = datetime.combine(hot_window_start(), time.min)
+    else:
+        since = state["watermark"] - SLA_REFRESH_SLACK
+    waiting_ids = list(state["waiting"].keys())
+    with engine.connect() as conn:
+        new_rows = conn.execute(text(new_query), {'since': since}).mappings().all()
+        changed_rows = conn.execute(text(changed_query), {'ids': waiting_ids}).mappings().all() if waiting_ids else []
+    
+    still_present = set()
+    for row in changed_rows:
+        still_present.add(row["id"])
+        if row["qcd_user"]:
+            state["waiting"].pop(row["id"], None)
+        else:
+            state["waiting"][row["id"]]["is_priority"] = row["is_priority"]
+    for task_id in waiting_ids:
+        if task_id not in still_present:
+            state["waiting"].pop(task_id, None)
+    
+    for row in new_rows:
+        state["waiting"].setdefault(row["id"], dict(row))
+        if state["watermark"] is None or row["date_finish"] > state["watermark"]:
+            state["watermark"] = row["date_finish"]
+    
+    # Оценка порогов - только в памяти
+    events = []
+    breaching = set()
+    for task_id, task in state["waiting"].items():
+        now = datetime.now(task["date_finish"].tzinfo)
+        wait_minutes = (now - task["date_finish"]).total_seconds() / 60
+        threshold = sla_threshold(task["machine_name"], task["is_priority"])
+        if wait_minutes < threshold:
+            continue
+        breaching.add(task_id)
+        alert = state["alerts"].get(task_id)
+        if alert is None:
+            alert = state["alerts"][task_id] = {
+                **task,
+                "first_breached_at": datetime.now().isoformat()
+            }
+            events.append({"type": "breach", "alert": alert})
+        alert["is_priority"] = task["is_priority"]
+        alert["wait_minutes"] = round(wait_minutes)
+        alert["threshold_minutes"] = threshold
+    
+    for task_id in list(state["alerts"]):
+        if task_id not in breaching:
+            events.append({"type": "resolved", "alert": state["alerts"].pop(task_id)})
+    
+    state["last_tick"] = datetime.now()
+    state["tick_ms"] = round((state["last_tick"] - started).total_seconds() * 1000)
+    if events:
+        print(f"SLA: {len(state['waiting'])} ожидают, превышений {len(state['alerts'])}, событий {len(events)}")
+    return events
+
+def publish_sla_events(events):
+    """Рассылает события подписчикам потока /api/sla-alerts/stream"""
+    for event_data in events:
+        payload = json.dumps(jsonable_encoder(event_data), ensure_ascii=False)
+        for queue in list(_sla_subscribers):
+            if queue.full():
+                continue
+            queue.put_nowait(payload)
+
+async def sla_watch_loop():
+    """Фоновый цикл наблюдателя: тик раз в SLA_TICK_SECONDS или сразу после записи результатов"""
+    while True:
+        try:
+            publish_sla_events(await run_in_threadpool(sla_tick))
+        except CircuitOpenError:
+            pass
+        except Exception as e:
+            print(f"Ошибка наблюдателя SLA: {e}")
+            print(traceback.format_exc())
+        try:
+            await asyncio.wait_for(_sla_wakeup.wait(), timeout=SLA_TICK_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _sla_wakeup.clear()
+
+@register_invalidation
+def wake_sla_watcher():
+    """Проверенные задачи сразу уходят из оповещений"""
+    _sla_wakeup.set()
+
+def sla_alerts_sorted():
+    """Оповещения: сначала приоритетные, затем по времени ожидания"""
+    return sorted(_sla_state["alerts"].values(), key=lambda a: (not a["is_priority"], -a["wait_minutes"]))
+
+@app.get("/api/sla-alerts")
+async def get_sla_alerts():
+    """Текущие превышения порогов ожидания (без обращения к БД)"""
+    waiting = list(_sla_state["waiting"].values())
+    return {
+        "alerts": sla_alerts_sorted(),
+        "waiting_count": len(waiting),
+        "priority_waiting_count": sum(1 for task in waiting if task["is_priority"]),
+        "thresholds": SLA_THRESHOLDS,
+        "last_tick": _sla_state["last_tick"].isoformat() if _sla_state["last_tick"] else None,
+        "tick_ms": _sla_state["tick_ms"]
+    }
+
+@app.get("/api/sla-alerts/stream")
+async def stream_sla_alerts(request: Request):
+    """Server-Sent Events: текущие оповещения при подключении, дальше - новые и снятые"""
+    queue = asyncio.Queue(maxsize=1000)
+    _sla_subscribers.add(queue)
+    
+    async def events():
+        try:
+            snapshot = json.dumps(jsonable_encoder({"type": "snapshot", "alerts": sla_alerts_sorted()}), ensure_ascii=False)
+            yield f"data: {snapshot}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    payload = await asyncio.wait_for(queue.get(), timeout=15)
+                    yield f"data: {payload}\n\n"
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            _sla_subscribers.discard(queue)
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/api/sla-thresholds")
+async def save_sla_thresholds(request: Request):
+    """Меняет пороги ожидания: {"default": {"priority": 60, "regular": 480}, "<станок>": {...}}"""
+    try:
+        # Сначала проверяем весь пакет, затем применяем одним update
+        thresholds = validate_sla_thresholds(await request.json())
+        SLA_THRESHOLDS.update(thresholds)
+        _sla_wakeup.set()
+        print(f"✅ Пороги SLA обновлены: {len(thresholds)} записей")
+        return {"status": "success", "thresholds": SLA_THRESHOLDS}
+    except Exception as e:
+        print(f"❌ Ошибка сохранения порогов SLA: {e}")
+        return {"status": "error", "message": str(e)}
+
+# Поиск по штрихкоду, номеру заказа и названию детали (триграммные индексы pg_trgm)
+SEARCH_COLUMNS = ("barcode", "orderNumber", "partName")
+SEARCH_MAX_LIMIT = 100
+_search_state = {"trgm": None}
+
+def ensure_search_indexes():
+    """
+    Включает pg_trgm и создает по одному триграммному GiST-индексу на колонку
+    (CONCURRENTLY - без блокировки записи): он обслуживает и ILIKE, и KNN-сортировку
+    по близости (<->). GIN-индексы прежней версии удаляются - они только замедляют запись
+    """
+    tables = ["KQCDTasks"] + (["KQCDTasks_archive"] if archive_exists() else [])
+    engine = get_db_engine()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        for table in tables:
+            for column in SEARCH_COLUMNS:
+                conn.execute(text(
+                    f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{table}_{column}_trgm_gist_idx" '
+                    f'ON "{table}" USING gist ((CAST("{column}" AS text)) gist_trgm_ops)'
+                ))
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{table}_{column}_trgm_idx"'))
+    _search_state["trgm"] = True
+    print(f"Индексы поиска готовы для {tables}")
+
+def trgm_available() -> bool:
+    """Установлено ли расширение pg_trgm (проверяется один раз)"""
+    if _search_state["trgm"] is None:
+        with get_db_engine(workload="search").connect() as conn:
+            _search_state["trgm"] = conn.execute(
+                text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            ).scalar() is not None
+    return _search_state["trgm"]
+
+def escape_like(value: str) -> str:
+    """Экранирует спецсимволы LIKE"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+SEARCH_SELECT = """
+    SELECT 
+        kt.id,
+        kt.barcode,
+        kt."orderNumber" as order_number,
+        kt."partName" as part_name,
+        kt."machineName" as machine_name,
+        kt.operator,
+        kt."dateFinish" as date_finish,
+        kt."operatorAmount" as quantity,
+        kt."qcdUser" as qcd_user,
+        kt."qcdDateFinish" as qcd_date_finish,
+        (kt."qcdUser" IS NULL OR kt."qcdUser" = '') as in_queue,
+        EXISTS (
+            SELECT 1 FROM "KOperations" ko
+            WHERE ko.barcode = kt.barcode AND ko."isPriority" = TRUE
+        ) as is_priority,
+        {match_rank} as match_rank,
+        {score} as score
+    FROM {tasks}
+    WHERE ({where})
+    AND NOT (kt.id = ANY(CAST(:exclude AS bigint[])))
+    ORDER BY {order}
+    LIMIT :limit
+"""
+
+@app.get("/api/search")
+def search_parts(q: str, limit: int = 20):
+    """
+    Поиск деталей по штрихкоду, номеру заказа и названию уровнями, каждый со своим LIMIT:
+    точные совпадения, затем префикс, затем (если мест еще осталось) подстрока
+    по близости триграмм - KNN-обход GiST-индекса (<->) по каждой колонке
+    """
+    q = q.strip()
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    if len(q) < 2:
+        return {"query": q, "results": [], "count": 0}
+    
+    try:
+        engine = get_db_engine(workload="search")
+        columns = [f'CAST(kt."{column}" AS text)' for column in SEARCH_COLUMNS]
+        tasks = tasks_source(alias="kt")
+        recent = 'kt."dateFinish" DESC NULLS LAST'
+        
+        tiers = [
+            # 0: точное совпадение штрихкода или номера заказа
+            (SEARCH_SELECT.format(
+                match_rank=0, score="1.0", tasks=tasks, order=recent,
+                where=f"{columns[0]} = :q OR {columns[1]} = :q"
+            ), {}),
+            # 1: префикс любой колонки
+            (SEARCH_SELECT.format(
+                match_rank=1, score="1.0", tasks=tasks, order=recent,
+                where=" OR ".join(f"{c} ILIKE :prefix" for c in columns)
+            ), {'prefix': escape_like(q) + "%"})
+        ]
+        # Короткий запрос (<3 символов) триграммы не ускоряют - только точные и префикс
+        if len(q) >= 3:
+            pattern = "%" + escape_like(q) + "%"
+            if trgm_available():
+                # Отдельный KNN-запрос на колонку: индекс отдает ближайшие строки сразу
+                # по порядку, сходство не считается для всех совпадений
+                knn = " UNION ALL ".join(
+                    "(" + SEARCH_SELECT.format(
+                        match_rank=2, score=f"1 - ({c} <-> :q)", tasks=tasks,
+                        where=f"{c} ILIKE :pattern", order=f"{c} <-> :q"
+                    ) + ")"
+                    for c in columns
+                )
+                query = f"""
+                    SELECT * FROM (
+                        SELECT DISTINCT ON (id) * FROM ({knn}) found ORDER BY id, score DESC
+                    ) best
+                    ORDER BY score DESC
+                    LIMIT :limit
+                """
+            else:
+                query = SEARCH_SELECT.format(
+                    match_rank=2, score="NULL", tasks=tasks, order=recent,
+                    where=" OR ".join(f"{c} ILIKE :pattern" for c in columns)
+                )
+            tiers.append((query, {'pattern': pattern}))
+        
+        results = []
+        found_ids = []
+        with engine.connect() as conn:
+            for query, params in tiers:
+                remaining = limit - len(results)
+                if remaining <= 0:
+                    break
+                df = pd.read_sql_query(text(query), conn, params={
+                    'q': q, 'exclude': found_ids, 'limit': remaining, **params
+                })
+                # Одна строка может совпасть по нескольким колонкам (KNN по каждой)
+                df = df.drop_duplicates('id')
+                results.extend(df.to_dict('records'))
+                found_ids.extend(int(task_id) for task_id in df['id'])
+        
+        return {"query": q, "results": results, "count": len(results)}
+        
+    except Exception as e:
+        print(f"Ошибка поиска '{q}': {e}")
+        print(traceback.format_exc())
+        return {"query": q, "results": [], "count": 0, "error": str(e)}
+
+@app.get("/api/admission-stats")
+async def get_admission_stats():
+    """Глубина очередей и счетчики отказов контроля допуска"""
+    return {gate.name: gate.status() for gate in all_admission_gates()}
+
+@app.get("/api/admin/profiles")
+async def get_profiles():
+    """Последние профилированные запросы и медленные запросы с профилем стека"""
+    return {
+        "enabled": PROFILING_ENABLED,
+        "sample_rate": PROFILE_SAMPLE_RATE,
+        "slow_threshold_ms": PROFILE_SLOW_MS,
+        "recent": [profile.summary() for profile in reversed(_recent_profiles)],
+        "slow": [profile.summary() for profile in reversed(_slow_profiles)]
+    }
+
+@app.get("/api/admin/profiles/{profile_id}")
+async def get_profile(profile_id: int):
+    """Полный профиль медленного запроса (cProfile, сортировка по cumulative)"""
+    for profile in _slow_profiles:
+        if profile.id == profile_id:
+            return {**profile.summary(), "stack": profile.stack}
+    return JSONResponse(status_code=404, content={"error": f"Профиль {profile_id} не найден"})
+
 @app.get("/api/test-relation")
 async def test_relation():
     """Тестируем связь между таблицами"""
@@ -1019,6 +3160,110 @@ async def load_employee_mappings():
 SERVER_EMPLOYEE_MAPPINGS = {}
 SERVER_HIDDEN_EMPLOYEES = []
 
+# Запуск: прогрев пулов, планов запросов и кэшей; /readyz - только после прогрева
+READINESS_RETRY_SECONDS = int(os.getenv("OTK_READINESS_RETRY_SECONDS", "10"))
+WARM_UP_POOLS = (("kontakt", "live"), ("kontakt", "analytics"), ("postgres", "live"))
+_readiness = {"ready": False, "status": "warming", "started_at": None, "finished_at": None, "steps": {}}
+_background_tasks = set()
+
+async def warm_up_step(name, func, *args):
+    """Выполняет шаг прогрева и запоминает длительность и ошибку"""
+    started = datetime.now()
+    step = {"ok": True}
+    try:
+        if asyncio.iscoroutinefunction(func):
+            # async-endpoint'ы внутри синхронно ходят в БД - гоняем их в отдельном
+            # цикле событий в потоке, чтобы не блокировать основной цикл
+            await run_in_threadpool(asyncio.run, func(*args))
+        else:
+            await run_in_threadpool(func, *args)
+    except Exception as e:
+        step = {"ok": False, "error": str(e)}
+        print(f"Прогрев: шаг {name} завершился ошибкой: {e}")
+    step["ms"] = round((datetime.now() - started).total_seconds() * 1000)
+    _readiness["steps"][name] = step
+    return step["ok"]
+
+def validate_pool(database, workload):
+    """Открывает соединение пула и проверяет его простым запросом"""
+    try:
+        with get_db_engine(database, workload).connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception as e:
+        if is_connection_error(e) and not isinstance(e, CircuitOpenError):
+            get_breaker(database, workload).record_failure(e)
+        raise
+
+async def warm_up():
+    """Прогревает импорты, пулы, планы горячих запросов и справочники"""
+    _readiness["started_at"] = datetime.now().isoformat()
+    await warm_up_step("import_pandas", importlib.import_module, "pandas")
+    
+    # Без рабочих пулов трафик не принимаем: состояние degraded и повтор проверки
+    while True:
+        pools_ok = True
+        for database, workload in WARM_UP_POOLS:
+            pools_ok &= await warm_up_step(f"pool_{database}_{workload}", validate_pool, database, workload)
+        if pools_ok:
+            break
+        _readiness["status"] = "degraded"
+        print(f"Прогрев: пулы БД недоступны, повтор через {READINESS_RETRY_SECONDS} с")
+        await asyncio.sleep(READINESS_RETRY_SECONDS)
+    
+    # Горячие запросы живых экранов: планы Postgres и снимки для отката
+    await warm_up_step("queue", get_otk_queue)
+    await warm_up_step("stats", get_stats)
+    await warm_up_step("today_stats", get_today_stats)
+    
+    # Справочники и аналитика
+    await warm_up_step("otk_employees", get_otk_employees)
+    await warm_up_step("qc_wait_sketches", refresh_qc_wait_sketches, True)
+    await warm_up_step("operators_cube", operators_cube.refresh, True)
+    
+    _readiness["ready"] = True
+    _readiness["status"] = "ready"
+    _readiness["finished_at"] = datetime.now().isoformat()
+    print(f"Прогрев завершен: {_readiness['steps']}")
+    
+    # Индексы очереди и поиска строятся долго и готовность не блокируют
+    await warm_up_step("queue_index", ensure_queue_index)
+    await warm_up_step("search_indexes", ensure_search_indexes)
+
+def start_background(coro):
+    """Запускает фоновую задачу и держит на нее ссылку до завершения"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def on_startup():
+    """Статика и снимки - до приема запросов, прогрев БД - в фоне"""
+    build_asset_manifest()
+    load_snapshots()
+    threading.Thread(target=snapshot_flush_loop, name="otk-snapshots", daemon=True).start()
+    start_background(warm_up())
+    start_background(sla_watch_loop())
+    if ARCHIVE_ENABLED:
+        threading.Thread(target=archive_loop, name="otk-archive", daemon=True).start()
+
+async def on_shutdown():
+    """Сохраняет снимки на диск и закрывает пулы соединений"""
+    for task in list(_background_tasks):
+        task.cancel()
+    flush_snapshots()
+    for engine in list(_db_engines.values()):
+        engine.dispose()
+
+@app.get("/healthz")
+async def healthz():
+    """Процесс жив (без обращения к БД)"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Готовность принимать трафик: 503, пока не завершен прогрев или пулы БД недоступны"""
+    return JSONResponse(status_code=200 if _readiness["ready"] else 503, content=_readiness)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="192.168.101.143", port=8503)